@@ -1,8 +1,9 @@
 import numpy as np
+import torch
 import torch.multiprocessing as mp
 
 
-__all__ = ['ReplayBuffer', 'EpisodeReplayBuffer']
+__all__ = ['ReplayBuffer', 'EpisodeReplayBuffer', 'TransitionCache']
 
 
 class ReplayBuffer(object):
@@ -10,34 +11,52 @@ class ReplayBuffer(object):
         self.capacity = capacity
         self.buffer = initializer()
         self.buffer_offset = Value('L', 0)
+        self.n_total_items = Value('L', 0)
         self.lock = Lock()
 
     def push(self, *args):
-        items = tuple(args)
+        # Each transition is stored with its insertion index as key (see TransitionCache)
         with self.lock:
+            key = self.n_total_items.value
+            items = (*args, key)
             if self.size < self.capacity:
                 self.buffer.append(items)
             else:
                 self.buffer[self.offset] = items
             self.offset = (self.offset + 1) % self.capacity
+            self.n_total_items.value = key + 1
 
     def extend(self, trajectory):
         with self.lock:
-            for items in map(tuple, trajectory):
-                if self.size < self.capacity:
-                    self.buffer.append(items)
-                else:
-                    self.buffer[self.offset] = items
-                self.offset = (self.offset + 1) % self.capacity
-
-    def sample(self, batch_size):
+            key = self.n_total_items.value
+            trajectory = [(*items, key + i) for i, items in enumerate(trajectory)]
+            self.n_total_items.value = key + len(trajectory)
+            offset = self.offset
+            size = self.size
+            if size < self.capacity:
+                n_appends = min(self.capacity - size, len(trajectory))
+                self.buffer.extend(trajectory[:n_appends])
+                trajectory = trajectory[n_appends:]
+                offset = (offset + n_appends) % self.capacity
+            while len(trajectory) > 0:
+                n_overwrites = min(self.capacity - offset, len(trajectory))
+                self.buffer[offset:offset + n_overwrites] = trajectory[:n_overwrites]
+                trajectory = trajectory[n_overwrites:]
+                offset = (offset + n_overwrites) % self.capacity
+            self.offset = offset
+
+    def sample(self, batch_size, return_keys=False):
         batch = []
         for i in np.random.randint(self.size, size=batch_size):
             batch.append(self.buffer[i])
 
         # size: (batch_size, item_size)
-        # observation, action, reward, next_observation, done
-        return tuple(map(np.stack, zip(*batch)))
+        # observation, action, reward, next_observation, done (, key)
+        *items, keys = zip(*batch)
+        items = tuple(map(np.stack, items))
+        if return_keys:
+            items += (np.asarray(keys, dtype=np.int64),)
+        return items
 
     def __len__(self):
         return self.size
@@ -117,3 +136,25 @@ class EpisodeReplayBuffer(ReplayBuffer):
     @property
     def size(self):
         return self.buffer_size.value
+
+
+class TransitionCache(object):
+    # Values computed from replay buffer transitions (e.g. encoded next observations), stored in per-transition
+    # slots aligned with the ring buffer slots (key % capacity) and tagged with the key of the transition,
+    # so a slot overwritten by a newer transition never hits
+    def __init__(self, capacity, item_size, device=None):
+        self.capacity = capacity
+        self.keys = torch.full(size=(capacity,), fill_value=-1, dtype=torch.int64, device=device)
+        self.values = torch.zeros(size=(capacity, item_size), dtype=torch.float32, device=device)
+
+    def lookup(self, keys):
+        slots = keys % self.capacity
+        return self.keys[slots] == keys, self.values[slots]
+
+    def update(self, keys, values):
+        slots = keys % self.capacity
+        self.keys[slots] = keys
+        self.values[slots] = values.to(dtype=self.values.dtype)
+
+    def clear(self):
+        self.keys.fill_(-1)
@@ -0,0 +1,152 @@
+import glob
+import json
+import os
+import queue
+import threading
+
+import torch
+
+from common.utils import CHECKPOINT_FORMAT, CHECKPOINT_PATTERN
+
+
+__all__ = ['CheckpointManager', 'find_checkpoint']
+
+
+MANIFEST_NAME = 'manifest.json'
+LATEST_NAME = 'latest.pkl'
+
+
+def snapshot(state):
+    # Copy all tensors to host memory, so training can continue while the snapshot is written
+    if isinstance(state, torch.Tensor):
+        return state.detach().to(device='cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(map(snapshot, state))
+    return state
+
+
+def load_manifest(checkpoint_dir):
+    try:
+        with open(file=os.path.join(checkpoint_dir, MANIFEST_NAME), mode='r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        pass
+
+    # Index checkpoints saved before the manifest existed (module weights only)
+    checkpoints = []
+    for path in glob.iglob(os.path.join(checkpoint_dir, '*.pkl')):
+        match = CHECKPOINT_PATTERN.match(path)
+        if match is not None:
+            checkpoints.append({'name': os.path.basename(path),
+                                'epoch': int(match.group('epoch')),
+                                'reward': float(match.group('reward')),
+                                'global_step': None})
+    checkpoints.sort(key=lambda entry: entry['epoch'])
+    return {'latest': None, 'checkpoints': checkpoints}
+
+
+def find_checkpoint(checkpoint_dir, by='epoch'):
+    # Look up the manifest entry of the latest (or best) checkpoint, the path is added as 'path'
+    manifest = load_manifest(checkpoint_dir)
+    entries = list(manifest['checkpoints'])
+    if manifest['latest'] is not None:
+        entries.append(manifest['latest'])
+    if len(entries) == 0:
+        return None
+
+    entry = dict(max(reversed(entries), key=lambda entry: entry[by]))
+    entry['path'] = os.path.join(checkpoint_dir, entry['name'])
+    return entry
+
+
+class CheckpointManager(object):
+    def __init__(self, checkpoint_dir, keep_last=None, keep_best=0):
+        # Keep the last N and the best K checkpoints by reward (keep all if keep_last is None)
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.manifest = load_manifest(checkpoint_dir)
+
+        # Exception raised in the writer thread, re-raised on the next save or close
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='checkpoint_writer', daemon=True)
+        self.thread.start()
+
+    def save(self, state, epoch, reward, global_step, keep=False):
+        # Snapshot the state synchronously and write it in background,
+        # the state is always saved as latest and also as a retained checkpoint if keep is True
+        self.check_error()
+        entry = {'name': LATEST_NAME, 'epoch': epoch, 'reward': float(reward), 'global_step': global_step}
+        self.queue.put((snapshot(state), entry, keep))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.write_checkpoint(*item)
+            except Exception as e:
+                self.error = e
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError(f'failed to write checkpoint to {self.checkpoint_dir}') from error
+
+    def write_checkpoint(self, state, entry, keep):
+        self.write(state, entry['name'])
+        self.manifest['latest'] = entry
+        if keep:
+            entry = dict(entry, name=CHECKPOINT_FORMAT(epoch=entry['epoch'], reward=entry['reward']))
+            self.write(state, entry['name'])
+            self.manifest['checkpoints'] = [other for other in self.manifest['checkpoints']
+                                            if other['name'] != entry['name']]
+            self.manifest['checkpoints'].append(entry)
+        removed = self.retain()
+        self.write_manifest()
+        for name in removed:
+            try:
+                os.remove(os.path.join(self.checkpoint_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def write(self, state, name):
+        # Write to a temporary file and rename atomically, so a checkpoint is never partially written
+        path = os.path.join(self.checkpoint_dir, name)
+        torch.save(state, f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+
+    def write_manifest(self):
+        path = os.path.join(self.checkpoint_dir, MANIFEST_NAME)
+        with open(file=f'{path}.tmp', mode='w') as file:
+            json.dump(self.manifest, file, indent=4)
+        os.replace(f'{path}.tmp', path)
+
+    def retain(self):
+        checkpoints = sorted(self.manifest['checkpoints'], key=lambda entry: entry['epoch'])
+        if self.keep_last is None:
+            return []
+
+        kept = checkpoints[max(len(checkpoints) - self.keep_last, 0):]
+        if self.keep_best > 0:
+            kept += sorted(checkpoints, key=lambda entry: entry['reward'], reverse=True)[:self.keep_best]
+        kept_names = {entry['name'] for entry in kept}
+
+        self.manifest['checkpoints'] = [entry for entry in checkpoints if entry['name'] in kept_names]
+        return [entry['name'] for entry in checkpoints if entry['name'] not in kept_names]
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,14 +1,14 @@
 import itertools
 import os
 import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 
 import numpy as np
 import torch.multiprocessing as mp
 import tqdm
-from PIL import Image, ImageDraw
 from setproctitle import setproctitle
-from torch.utils.tensorboard import SummaryWriter
 
 from .buffer import ReplayBuffer, EpisodeReplayBuffer
 from .utils import clone_network, sync_params
@@ -25,7 +25,8 @@ class Sampler(mp.Process):
                  n_total_steps, episode_steps, episode_rewards,
                  n_episodes, max_episode_steps,
                  deterministic, random_sample, render, log_episode_video,
-                 device, random_seed, log_dir):
+                 device, random_seed, log_dir, async_reset=False, jit_policy=False,
+                 quantize_policy=False):
         super().__init__(name=f'sampler_{rank}', daemon=True)
 
         self.rank = rank
@@ -39,11 +40,23 @@ class Sampler(mp.Process):
         self.env_func = env_func
         self.env_kwargs = env_kwargs
         self.random_seed = random_seed
+        self.env_reset = None
+
+        self.async_reset = async_reset
+        self.spare_env = None
+        self.spare_env_reset = None
+        self.spare_random_seed = random_seed + n_samplers
+        self.executor = None
 
         self.shared_state_encoder = state_encoder
         self.shared_actor = actor
         self.state_encoder = None
         self.actor = None
+        self.policy = None
+        self.float_policy = None
+        self.jit_policy = jit_policy
+        self.quantize_policy = quantize_policy
+        self.action_divergence = None
         self.device = device
         self.eval_only = eval_only
 
@@ -76,12 +89,22 @@ class Sampler(mp.Process):
 
         self.env = self.env_func(**self.env_kwargs)
         self.env.seed(self.random_seed)
+        if self.async_reset:
+            self.spare_env = self.env_func(**self.env_kwargs)
+            self.spare_env.seed(self.spare_random_seed)
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{self.name}_reset')
+            self.spare_env_reset = self.executor.submit(self.spare_env.reset)
 
         if not self.random_sample:
             self.state_encoder = clone_network(src_net=self.shared_state_encoder, device=self.device)
             self.actor = clone_network(src_net=self.shared_actor, device=self.device)
             self.state_encoder.eval().requires_grad_(False)
             self.actor.eval().requires_grad_(False)
+            self.policy = self.float_policy = self.state_encoder.build_policy(self.actor, jit=self.jit_policy)
+            if self.quantize_policy and (self.device.type != 'cpu' or not hasattr(self.policy, 'quantized')):
+                warnings.warn(f'Quantized policy is not supported by {self.name}, use float policy instead.')
+                self.quantize_policy = False
+            self.refresh_policy()
 
         self.episode = 0
         while self.episode < self.n_episodes:
@@ -90,13 +113,14 @@ class Sampler(mp.Process):
             if not (self.eval_only or self.random_sample):
                 sync_params(src_net=self.shared_state_encoder, dst_net=self.state_encoder)
                 sync_params(src_net=self.shared_actor, dst_net=self.actor)
+                self.refresh_policy()
 
             episode_reward = 0
             episode_steps = 0
             self.trajectory.clear()
             if self.state_encoder is not None:
                 self.state_encoder.reset()
-            observation = self.env.reset()
+            observation = self.reset_env()
             self.render()
             self.frames.clear()
             self.save_frame(step=0, reward=np.nan, episode_reward=0.0)
@@ -104,8 +128,7 @@ class Sampler(mp.Process):
                 if self.random_sample:
                     action = self.env.action_space.sample()
                 else:
-                    state = self.state_encoder.encode(observation)
-                    action = self.actor.get_action(state, deterministic=self.deterministic)
+                    action = self.policy.get_action(observation, deterministic=self.deterministic)
                 next_observation, reward, done, _ = self.env.step(action)
 
                 episode_reward += reward
@@ -119,6 +142,7 @@ class Sampler(mp.Process):
                 if done:
                     break
 
+            self.swap_env()
             self.running_event.wait()
             self.event.wait(timeout=self.timeout)
             with self.lock:
@@ -133,14 +157,55 @@ class Sampler(mp.Process):
                 self.writer.add_scalar(tag='sample/cumulative_reward', scalar_value=episode_reward, global_step=self.episode)
                 self.writer.add_scalar(tag='sample/average_reward', scalar_value=average_reward, global_step=self.episode)
                 self.writer.add_scalar(tag='sample/episode_steps', scalar_value=episode_steps, global_step=self.episode)
+                if self.action_divergence is not None:
+                    self.writer.add_scalar(tag='sample/quantized_action_divergence',
+                                           scalar_value=self.action_divergence, global_step=self.episode)
                 self.log_video()
                 self.writer.flush()
 
-        self.env.close()
+        self.close_env()
 
         if self.writer is not None:
             self.writer.close()
 
+    def refresh_policy(self):
+        if not self.quantize_policy:
+            return
+
+        # Rebuild the int8 policy from the published float weights and compare their deterministic actions
+        # on observations of the previous episode
+        self.policy = self.float_policy.quantized()
+        if self.writer is not None and len(self.trajectory) > 0:
+            observations = [transaction[0] for transaction in self.trajectory[::max(1, len(self.trajectory) // 256)]]
+            actions = self.float_policy.deterministic_actions(observations)
+            quantized_actions = self.policy.deterministic_actions(observations)
+            self.action_divergence = (actions - quantized_actions).abs().mean().item()
+
+    def reset_env(self):
+        if self.env_reset is None:
+            return self.env.reset()
+
+        observation = self.env_reset.result()
+        self.env_reset = None
+        return observation
+
+    def swap_env(self):
+        if self.spare_env is None:
+            return
+
+        # Use the pre-reset spare environment for the next episode and reset the finished one in background.
+        # The environments are used alternately, so the episodes are still deterministic for each rank.
+        self.env, self.spare_env = self.spare_env, self.env
+        self.env_reset = self.spare_env_reset
+        self.spare_env_reset = self.executor.submit(self.spare_env.reset)
+
+    def close_env(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        for env in (self.env, self.spare_env):
+            if env is not None:
+                env.close()
+
     def add_transaction(self, observation, action, reward, next_observation, done):
         self.trajectory.append((observation, action, [reward], next_observation, [done]))
 
@@ -149,7 +214,7 @@ class Sampler(mp.Process):
 
     def close(self):
         try:
-            self.env.close()
+            self.close_env()
         except Exception:
             pass
         try:
@@ -175,6 +240,8 @@ class Sampler(mp.Process):
             except Exception:
                 pass
             else:
+                from PIL import Image, ImageDraw
+
                 text = (f'step           = {step}\n'
                         f'reward         = {reward:+.3f}\n'
                         f'episode reward = {episode_reward:+.3f}')
@@ -197,26 +264,185 @@ class Sampler(mp.Process):
     @lru_cache(maxsize=None)
     def writer(self):
         if not self.random_sample and self.log_dir is not None:
+            from torch.utils.tensorboard import SummaryWriter
+
             return SummaryWriter(log_dir=os.path.join(self.log_dir, self.name), comment=self.name)
         else:
             return None
 
 
 class EpisodeSampler(Sampler):
+    def __init__(self, *args, hidden_interval=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hidden_interval = hidden_interval
+        self.hiddens = []
+
     def add_transaction(self, observation, action, reward, next_observation, done):
         self.trajectory.append((observation, action, [reward], [done]))
 
+        # Store the encoder hidden state before step k * hidden_interval (k >= 1) for burn-in replay
+        if self.hidden_interval is not None and len(self.trajectory) % self.hidden_interval == 0:
+            hidden = getattr(self.state_encoder, 'hidden', None)
+            if hidden is not None:
+                self.hiddens.append(hidden[0].cpu().numpy().copy())
+
+    def save_trajectory(self):
+        items = tuple(map(np.stack, zip(*self.trajectory)))
+        if self.hidden_interval is not None:
+            hiddens = (np.stack(self.hiddens) if len(self.hiddens) > 0 else np.zeros(shape=(0,), dtype=np.float32))
+            items = (*items, hiddens)
+        self.replay_buffer.push(*items)
+        self.hiddens.clear()
+
+
+class WarmupSampler(mp.Process):
+    def __init__(self, rank, n_samplers, lock,
+                 env_func, env_kwargs, replay_buffer,
+                 n_total_steps, episode_steps, episode_rewards,
+                 n_samples, max_episode_steps, block_size,
+                 random_seed):
+        super().__init__(name=f'warmup_sampler_{rank}', daemon=True)
+
+        self.rank = rank
+        self.lock = lock
+
+        self.env = None
+        self.env_func = env_func
+        self.env_kwargs = env_kwargs
+        self.random_seed = random_seed
+        self.random_state = None
+
+        self.replay_buffer = replay_buffer
+        self.n_total_steps = n_total_steps
+        self.episode_steps = episode_steps
+        self.episode_rewards = episode_rewards
+
+        self.n_samples = n_samples // n_samplers
+        if rank < n_samples % n_samplers:
+            self.n_samples += 1
+        self.max_episode_steps = max_episode_steps
+        self.block_size = block_size
+
+        self.block = None
+        self.block_offset = 0
+        self.actions = None
+        self.action_offset = 0
+
+    def run(self):
+        setproctitle(title=self.name)
+
+        self.env = self.env_func(**self.env_kwargs)
+        self.env.seed(self.random_seed)
+        self.random_state = np.random.RandomState(self.random_seed)
+        self.allocate_block()
+
+        n_steps = 0
+        while n_steps < self.n_samples:
+            episode_reward = 0
+            episode_steps = 0
+            observation = self.env.reset()
+            for step in range(min(self.max_episode_steps, self.n_samples - n_steps)):
+                action = self.random_action()
+                next_observation, reward, done, _ = self.env.step(action)
+
+                episode_reward += reward
+                episode_steps += 1
+                self.add_transaction(observation, action, reward, next_observation, done)
+
+                observation = next_observation
+
+                if done:
+                    break
+
+            n_steps += episode_steps
+            self.save_episode(episode_steps, episode_reward)
+
+        self.save_trajectory()
+        self.env.close()
+
+    def allocate_block(self):
+        observation_space = self.env.observation_space
+        action_space = self.env.action_space
+        self.block = (np.zeros(shape=(self.block_size, *observation_space.shape), dtype=observation_space.dtype),
+                      np.zeros(shape=(self.block_size, *action_space.shape), dtype=action_space.dtype),
+                      np.zeros(shape=(self.block_size, 1), dtype=np.float32),
+                      np.zeros(shape=(self.block_size, *observation_space.shape), dtype=observation_space.dtype),
+                      np.zeros(shape=(self.block_size, 1), dtype=np.bool_))
+        self.block_offset = 0
+
+    def random_action(self):
+        if self.actions is None or self.action_offset >= len(self.actions):
+            action_space = self.env.action_space
+            self.actions = self.random_state.uniform(low=action_space.low, high=action_space.high,
+                                                     size=(self.block_size, *action_space.shape))
+            self.actions = self.actions.astype(action_space.dtype)
+            self.action_offset = 0
+
+        action = self.actions[self.action_offset]
+        self.action_offset += 1
+        return action
+
+    def add_transaction(self, observation, action, reward, next_observation, done):
+        observations, actions, rewards, next_observations, dones = self.block
+        observations[self.block_offset] = observation
+        actions[self.block_offset] = action
+        rewards[self.block_offset] = reward
+        next_observations[self.block_offset] = next_observation
+        dones[self.block_offset] = done
+        self.block_offset += 1
+
+        if self.block_offset == self.block_size:
+            self.save_trajectory()
+
     def save_trajectory(self):
-        self.replay_buffer.push(*tuple(map(np.stack, zip(*self.trajectory))))
+        if self.block_offset > 0:
+            self.replay_buffer.extend(zip(*(items[:self.block_offset] for items in self.block)))
+        self.block_offset = 0
+
+    def save_episode(self, episode_steps, episode_reward):
+        with self.lock:
+            self.n_total_steps.value += episode_steps
+            self.episode_steps.append(episode_steps)
+            self.episode_rewards.append(episode_reward)
+
+
+class EpisodeWarmupSampler(WarmupSampler):
+    def allocate_block(self):
+        observation_space = self.env.observation_space
+        action_space = self.env.action_space
+        self.block_size = self.max_episode_steps
+        self.block = (np.zeros(shape=(self.block_size, *observation_space.shape), dtype=observation_space.dtype),
+                      np.zeros(shape=(self.block_size, *action_space.shape), dtype=action_space.dtype),
+                      np.zeros(shape=(self.block_size, 1), dtype=np.float32),
+                      np.zeros(shape=(self.block_size, 1), dtype=np.bool_))
+        self.block_offset = 0
+
+    def add_transaction(self, observation, action, reward, next_observation, done):
+        observations, actions, rewards, dones = self.block
+        observations[self.block_offset] = observation
+        actions[self.block_offset] = action
+        rewards[self.block_offset] = reward
+        dones[self.block_offset] = done
+        self.block_offset += 1
+
+    def save_trajectory(self):
+        if self.block_offset > 0:
+            self.replay_buffer.push(*(items[:self.block_offset].copy() for items in self.block))
+        self.block_offset = 0
+
+    def save_episode(self, episode_steps, episode_reward):
+        self.save_trajectory()
+        super().save_episode(episode_steps, episode_reward)
 
 
 class Collector(object):
     SAMPLER = Sampler
+    WARMUP_SAMPLER = WarmupSampler
     REPLAY_BUFFER = ReplayBuffer
 
     def __init__(self, env_func, env_kwargs, state_encoder, actor,
                  n_samplers, buffer_capacity,
-                 devices, random_seed):
+                 devices, random_seed, async_reset=False, jit_policy=False, quantize_policy=False):
         self.manager = mp.Manager()
         self.running_event = self.manager.Event()
         self.running_event.set()
@@ -237,6 +463,14 @@ class Collector(object):
         self.env_kwargs = env_kwargs
         self.devices = [device for _, device in zip(range(n_samplers), itertools.cycle(devices))]
         self.random_seed = random_seed
+        self.async_reset = async_reset
+        if async_reset and env_kwargs.get('vision_observation', False):
+            # Rendering (e.g. OpenGL contexts of pybullet) is not thread-safe,
+            # the spare environment would render in the reset thread while the other one steps
+            warnings.warn('Asynchronous reset is not supported with vision observation, reset synchronously instead.')
+            self.async_reset = False
+        self.jit_policy = jit_policy
+        self.quantize_policy = quantize_policy
 
         self.samplers = []
 
@@ -265,12 +499,16 @@ class Collector(object):
                                    self.total_steps, self.episode_steps, self.episode_rewards,
                                    n_episodes, max_episode_steps,
                                    deterministic, random_sample, render, log_episode_video,
-                                   self.devices[rank], self.random_seed + rank, log_dir)
+                                   self.devices[rank], self.random_seed + rank, log_dir,
+                                   **self.sampler_kwargs())
             sampler.start()
             self.samplers.append(sampler)
 
         return self.samplers
 
+    def sampler_kwargs(self):
+        return dict(async_reset=self.async_reset, jit_policy=self.jit_policy, quantize_policy=self.quantize_policy)
+
     def sample(self, n_episodes, max_episode_steps, deterministic=False, random_sample=False,
                render=False, log_episode_video=False, log_dir=None):
         n_initial_episodes = self.n_episodes
@@ -291,6 +529,37 @@ class Collector(object):
 
         self.join()
 
+    def warmup(self, n_samples, max_episode_steps, block_size=1000):
+        self.resume()
+
+        n_initial_samples = self.n_total_steps
+
+        for rank in range(self.n_samplers):
+            sampler = self.WARMUP_SAMPLER(rank, self.n_samplers, self.lock,
+                                          self.env_func, self.env_kwargs, self.replay_buffer,
+                                          self.total_steps, self.episode_steps, self.episode_rewards,
+                                          n_samples, max_episode_steps, block_size,
+                                          self.random_seed + rank)
+            sampler.start()
+            self.samplers.append(sampler)
+
+        pbar = tqdm.tqdm(total=n_samples, desc='Warming up')
+        while any(sampler.is_alive() for sampler in self.samplers):
+            n_new_samples = min(self.n_total_steps - n_initial_samples, n_samples)
+            if n_new_samples > pbar.n:
+                pbar.n = n_new_samples
+                pbar.set_postfix({'buffer_size': self.replay_buffer.size})
+            time.sleep(0.1)
+        pbar.n = min(self.n_total_steps - n_initial_samples, n_samples)
+        pbar.close()
+
+        # Do not start training on a partial buffer if any warmup sampler crashed
+        failed = [sampler.name for sampler in self.samplers if sampler.exitcode != 0]
+        self.join()
+        if len(failed) > 0:
+            raise RuntimeError(f'warmup samplers {failed} exited with errors '
+                               f'({self.n_total_steps - n_initial_samples}/{n_samples} samples collected)')
+
     def join(self):
         for sampler in self.samplers:
             sampler.join()
@@ -323,4 +592,12 @@ class Collector(object):
 
 class EpisodeCollector(Collector):
     SAMPLER = EpisodeSampler
+    WARMUP_SAMPLER = EpisodeWarmupSampler
     REPLAY_BUFFER = EpisodeReplayBuffer
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hidden_interval = None
+
+    def sampler_kwargs(self):
+        return dict(super().sampler_kwargs(), hidden_interval=self.hidden_interval)
@@ -1,8 +1,8 @@
-from collections import deque
+import json
+import os
 
 import gym
 import numpy as np
-import torchvision.transforms as transforms
 from gym.spaces import Box
 from gym.wrappers import TimeLimit
 
@@ -10,35 +10,53 @@ from gym.wrappers import TimeLimit
 __all__ = [
     'build_env', 'initialize_environment',
     'FlattenedAction', 'NormalizedAction',
-    'FlattenedObservation', 'VisionObservation', 'ConcatenatedObservation'
+    'FlattenedObservation', 'VisionObservation', 'ConcatenatedObservation',
+    'FusedTransform', 'FrameStack', 'ActionRepeat'
 ]
 
-try:
-    import pybullet_envs
-except ImportError:
-    pass
+ENV_SPEC_CACHE = 'env_spec.json'
 
-try:
-    import mujoco_py
-except Exception:
-    pass
+
+def make_env(name):
+    try:
+        return gym.make(name)
+    except gym.error.Error:
+        pass
+
+    # Optional environment families are only imported (and registered) on demand
+    try:
+        import pybullet_envs
+    except ImportError:
+        pass
+
+    return gym.make(name)
 
 
 def build_env(**kwargs):
-    env = gym.make(kwargs['name'])
+    env = make_env(kwargs['name'])
     env.seed(kwargs['random_seed'])
 
-    env = NormalizedAction(FlattenedAction(env))
-    if kwargs['vision_observation']:
-        env = VisionObservation(env, image_size=(kwargs['image_size'], kwargs['image_size']))
+    action_repeat = kwargs.get('action_repeat', 1)
+    if action_repeat > 1:
+        env = ActionRepeat(env, action_repeat=action_repeat)
+
+    if kwargs.get('fused_wrappers', False):
+        env = FusedTransform(env,
+                             vision_observation=kwargs['vision_observation'],
+                             image_size=(kwargs['image_size'], kwargs['image_size']),
+                             n_frames=kwargs['n_frames'], dim=0)
     else:
-        env = FlattenedObservation(env)
-    if kwargs['n_frames'] > 1:
-        env = ConcatenatedObservation(env, n_frames=kwargs['n_frames'], dim=0)
+        env = NormalizedAction(FlattenedAction(env))
+        if kwargs['vision_observation']:
+            env = VisionObservation(env, image_size=(kwargs['image_size'], kwargs['image_size']))
+        else:
+            env = FlattenedObservation(env)
+        if kwargs['n_frames'] > 1:
+            env = ConcatenatedObservation(env, n_frames=kwargs['n_frames'], dim=0)
 
     max_episode_steps = kwargs['max_episode_steps']
     try:
-        max_episode_steps = min(max_episode_steps, env.spec.max_episode_steps)
+        max_episode_steps = min(max_episode_steps, int(np.ceil(env.spec.max_episode_steps / action_repeat)))
     except AttributeError:
         pass
     except TypeError:
@@ -53,26 +71,84 @@ def initialize_environment(config):
     config.env_kwargs = config.build_from_keys(['vision_observation',
                                                 'image_size',
                                                 'n_frames',
+                                                'fused_wrappers',
+                                                'action_repeat',
                                                 'max_episode_steps',
                                                 'random_seed'])
     config.env_kwargs.update(name=config.env)
 
-    with config.env_func(**config.env_kwargs) as env:
-        print(f'env = {env}')
-        print(f'observation_space.shape = {env.observation_space.shape}')
-        print(f'action_space.shape = {env.action_space.shape}')
+    env_spec = get_env_spec(config.env_func, config.env_kwargs,
+                            cache_dir=config.checkpoint_dir, refresh=config.refresh_env_spec)
+    print(f'env = {env_spec["env"]}')
+    print(f'observation_space.shape = {tuple(env_spec["observation_shape"])}')
+    print(f'action_space.shape = {tuple(env_spec["action_shape"])}')
 
-        config.observation_dim = env.observation_space.shape[0]
-        config.action_dim = env.action_space.shape[0]
+    config.observation_dim = env_spec['observation_shape'][0]
+    config.action_dim = env_spec['action_shape'][0]
+    try:
+        config.max_episode_steps = min(config.max_episode_steps, env_spec['max_episode_steps'])
+    except TypeError:
+        pass
+    config.env_kwargs['max_episode_steps'] = config.max_episode_steps
+    if config.RNN_encoder:
+        assert config.step_size <= config.max_episode_steps
+
+
+def get_env_spec(env_func, env_kwargs, cache_dir=None, refresh=False):
+    # The spec is cached by environment name and wrapper arguments to skip building a probe environment
+    key = json.dumps({name: value for name, value in env_kwargs.items()
+                      if name not in ('max_episode_steps', 'random_seed')}, sort_keys=True)
+    cache_file = None
+    cache = {}
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, ENV_SPEC_CACHE)
+        try:
+            with open(file=cache_file, mode='r') as file:
+                cache = json.load(file)
+        except (OSError, ValueError):
+            cache = {}
+    if not refresh and key in cache:
+        return cache[key]
+
+    # Probe without the step limit from arguments, TimeLimit writes the limit of policy steps back to the spec
+    with env_func(**{**env_kwargs, 'max_episode_steps': np.inf}) as env:
         try:
-            config.max_episode_steps = min(config.max_episode_steps, env.spec.max_episode_steps)
+            max_episode_steps = env.spec.max_episode_steps
         except AttributeError:
-            pass
-        except TypeError:
-            pass
-        config.env_kwargs['max_episode_steps'] = config.max_episode_steps
-        if config.RNN_encoder:
-            assert config.step_size <= config.max_episode_steps
+            max_episode_steps = None
+        if max_episode_steps is not None and np.isinf(max_episode_steps):
+            max_episode_steps = None
+        env_spec = {
+            'env': str(env),
+            'observation_shape': list(env.observation_space.shape),
+            'action_shape': list(env.action_space.shape),
+            'max_episode_steps': max_episode_steps
+        }
+
+    if cache_file is not None:
+        cache[key] = env_spec
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(file=f'{cache_file}.tmp', mode='w') as file:
+            json.dump(cache, file, indent=4)
+        os.replace(f'{cache_file}.tmp', cache_file)
+
+    return env_spec
+
+
+class ActionRepeat(gym.Wrapper):
+    def __init__(self, env, action_repeat=4):
+        super().__init__(env=env)
+        self.action_repeat = action_repeat
+
+    def step(self, action):
+        # Observation wrappers outside (e.g. VisionObservation) only observe the last sub-step
+        total_reward = 0.0
+        for _ in range(self.action_repeat):
+            observation, reward, done, info = self.env.step(action)
+            total_reward += reward
+            if done:
+                break
+        return observation, total_reward, done, info
 
 
 class FlattenedAction(gym.ActionWrapper):
@@ -130,48 +206,151 @@ class FlattenedObservation(gym.ObservationWrapper):
 class VisionObservation(gym.ObservationWrapper):
     def __init__(self, env, image_size=(128, 128)):
         super().__init__(env=env)
-        self.observation_space = Box(low=0.0, high=1.0, shape=(3, *image_size), dtype=np.float32)
+        # Keep images in uint8 (CHW), they are normalized to [0.0, 1.0] at the input of the state encoder
+        self.observation_space = Box(low=0, high=255, shape=(3, *image_size), dtype=np.uint8)
         self.image_size = image_size
 
-        self.transform = transforms.Compose([
-            transforms.ToPILImage(),
-            transforms.Resize(size=image_size),
-            transforms.ToTensor()
-        ])
-
         self.unwrapped_observation_space = self.env.observation_space
         self.unwrapped_observation = None
 
     def observation(self, observation):
         self.unwrapped_observation = observation
 
-        obs = self.render(mode='rgb_array')
-        obs = self.transform(obs).cpu().detach().numpy()
-
-        return obs
+        return resize_image(self.render(mode='rgb_array'), image_size=self.image_size)
 
 
 class ConcatenatedObservation(gym.ObservationWrapper):
-    def __init__(self, env, n_frames=3, dim=0):
+    def __init__(self, env, n_frames=3, dim=0, capacity=256):
         super().__init__(env=env)
 
         self.observation_space = Box(low=np.concatenate([self.env.observation_space.low] * n_frames, axis=dim),
                                      high=np.concatenate([self.env.observation_space.high] * n_frames, axis=dim),
                                      dtype=self.env.observation_space.dtype)
 
-        self.queue = deque(maxlen=n_frames)
-        self.dim = dim
+        self.frame_stack = FrameStack(n_frames=n_frames, dim=dim, capacity=capacity)
 
     def reset(self, **kwargs):
-        self.queue.clear()
+        self.frame_stack.clear()
         return super().reset(**kwargs)
 
     def observation(self, observation):
-        while len(self.queue) < self.n_frames - 1:
-            self.queue.append(observation)
-        self.queue.append(observation)
-        return np.concatenate(self.queue, axis=self.dim)
+        return self.frame_stack.push(observation)
 
     @property
     def n_frames(self):
-        return self.queue.maxlen
+        return self.frame_stack.n_frames
+
+    @property
+    def dim(self):
+        return self.frame_stack.dim
+
+
+class FusedTransform(gym.Wrapper):
+    # Equivalent to ConcatenatedObservation(FlattenedObservation(NormalizedAction(FlattenedAction(env))))
+    # (or VisionObservation instead of FlattenedObservation) in a single wrapper,
+    # the affine action transform is precomputed and applied in place
+    def __init__(self, env, vision_observation=False, image_size=(128, 128), n_frames=1, dim=0, capacity=256):
+        super().__init__(env=env)
+
+        low = self.env.action_space.low.ravel()
+        high = self.env.action_space.high.ravel()
+        self.action_space = Box(low=-1.0, high=1.0, shape=low.shape, dtype=np.float32)
+        self.action_low = low
+        self.action_high = high
+        self.action_scale = 0.5 * (high - low)
+        self.action_offset = low + self.action_scale
+        self.action_shape = self.env.action_space.shape
+        self.action_buffer = np.zeros_like(self.action_offset)
+
+        self.vision_observation = vision_observation
+        self.image_size = image_size
+        if vision_observation:
+            observation_space = Box(low=0, high=255, shape=(3, *image_size), dtype=np.uint8)
+        else:
+            observation_space = Box(low=self.env.observation_space.low.ravel(),
+                                    high=self.env.observation_space.high.ravel(),
+                                    dtype=np.float32)
+
+        self.frame_stack = None
+        if n_frames > 1:
+            observation_space = Box(low=np.concatenate([observation_space.low] * n_frames, axis=dim),
+                                    high=np.concatenate([observation_space.high] * n_frames, axis=dim),
+                                    dtype=observation_space.dtype)
+            self.frame_stack = FrameStack(n_frames=n_frames, dim=dim, capacity=capacity)
+        self.observation_space = observation_space
+
+    def reset(self, **kwargs):
+        if self.frame_stack is not None:
+            self.frame_stack.clear()
+        return self.observation(self.env.reset(**kwargs))
+
+    def step(self, action):
+        observation, reward, done, info = self.env.step(self.action(action))
+        return self.observation(observation), reward, done, info
+
+    def action(self, action):
+        buffer = self.action_buffer
+        np.multiply(np.ravel(action), self.action_scale, out=buffer)
+        np.add(buffer, self.action_offset, out=buffer)
+        np.maximum(buffer, self.action_low, out=buffer)
+        np.minimum(buffer, self.action_high, out=buffer)
+        return buffer.reshape(self.action_shape)
+
+    def observation(self, observation):
+        if self.vision_observation:
+            observation = resize_image(self.render(mode='rgb_array'), image_size=self.image_size)
+        else:
+            observation = np.ravel(observation)
+        if self.frame_stack is not None:
+            observation = self.frame_stack.push(observation)
+        return observation
+
+
+class FrameStack(object):
+    def __init__(self, n_frames=3, dim=0, capacity=256):
+        self.n_frames = n_frames
+        self.dim = dim
+        self.capacity = max(capacity, 2 * n_frames)
+
+        # Consecutive frames are stored in a preallocated block, the concatenated observation along
+        # dimension 0 is a contiguous view of N frames which shares storage with its neighbors
+        self.frames = None
+        self.offset = 0
+
+    def clear(self):
+        self.frames = None
+        self.offset = 0
+
+    def push(self, frame):
+        frame = np.asanyarray(frame)
+        if self.frames is None:
+            self.frames = np.empty(shape=(self.capacity, *frame.shape), dtype=frame.dtype)
+            self.frames[:self.n_frames] = frame
+            self.offset = self.n_frames
+        else:
+            if self.offset == self.capacity:
+                # Allocate a new block rather than overwrite the old one,
+                # previous observations may still be referenced by the trajectory
+                frames = np.empty_like(self.frames)
+                frames[:self.n_frames - 1] = self.frames[self.offset - self.n_frames + 1:]
+                self.frames = frames
+                self.offset = self.n_frames - 1
+            self.frames[self.offset] = frame
+            self.offset += 1
+
+        frames = self.frames[self.offset - self.n_frames:self.offset]
+        if self.dim == 0:
+            return frames.reshape(-1, *frames.shape[2:])
+        return np.concatenate(frames, axis=self.dim)
+
+
+def resize_image(image, image_size):
+    from PIL import Image
+
+    height, width = image_size
+    if image.shape[:2] != (height, width):
+        image = Image.fromarray(np.ascontiguousarray(image, dtype=np.uint8), mode='RGB')
+        image = image.resize(size=(width, height), resample=Image.BILINEAR, reducing_gap=2.0)
+        image = np.asarray(image)
+
+    return np.ascontiguousarray(image.transpose((2, 0, 1)), dtype=np.uint8)
@@ -0,0 +1,107 @@
+import queue
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+__all__ = ['MetricsAccumulator', 'AsyncWriter', 'check_reduction']
+
+
+def check_reduction(reduction):
+    if reduction in ('mean', 'min', 'max', 'std'):
+        return reduction
+    if reduction.startswith('p'):
+        try:
+            if 0.0 <= float(reduction[1:]) <= 100.0:
+                return reduction
+        except ValueError:
+            pass
+    raise ValueError(f"invalid reduction '{reduction}' (expected 'mean', 'min', 'max', 'std' or 'pNN')")
+
+
+def reduce(values, reduction):
+    if reduction == 'mean':
+        return values.mean()
+    elif reduction == 'min':
+        return values.min()
+    elif reduction == 'max':
+        return values.max()
+    elif reduction == 'std':
+        return values.std(unbiased=False)
+    else:  # percentile 'pNN'
+        return torch.quantile(values, q=float(reduction[1:]) / 100.0)
+
+
+class MetricsAccumulator(object):
+    def __init__(self, reductions=('mean',)):
+        self.reductions = list(map(check_reduction, reductions))
+        self.values = OrderedDict()
+
+    def add(self, tag, value):
+        self.values.setdefault(tag, []).append(value)
+
+    def update(self, metrics, prefix=''):
+        for tag, value in metrics.items():
+            self.add(tag=f'{prefix}{tag}', value=value)
+
+    def reduce(self):
+        # Reduce on device and transfer all results to host at once
+        tags = []
+        results = []
+        for tag, values in self.values.items():
+            values = torch.stack(list(map(torch.as_tensor, values))).float()
+            for reduction in self.reductions:
+                tags.append(tag if reduction == 'mean' else f'{tag}/{reduction}')
+                results.append(reduce(values, reduction))
+        self.values.clear()
+
+        if len(results) == 0:
+            return OrderedDict()
+
+        device = results[0].device
+        results = torch.stack([result.to(device) for result in results]).cpu().tolist()
+        return OrderedDict(zip(tags, results))
+
+    def flush(self, writer, global_step):
+        results = self.reduce()
+        for tag, value in results.items():
+            writer.add_scalar(tag=tag, scalar_value=value, global_step=global_step)
+        return results
+
+    def __len__(self):
+        return len(self.values)
+
+
+class AsyncWriter(object):
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='async_writer', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            method, args, kwargs = item
+            getattr(self.writer, method)(*args, **kwargs)
+
+    def add_scalar(self, *args, **kwargs):
+        self.queue.put(('add_scalar', args, kwargs))
+
+    def flush(self):
+        self.queue.put(('flush', (), {}))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,6 +1,8 @@
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 __all__ = [
@@ -32,6 +34,7 @@ def build_encoder(config):
                                                                  state_dim],
                                                skip_connection=config.skip_connection,
                                                trainable_initial_hidden=config.trainable_hidden,
+                                               gradient_checkpointing=config.gradient_checkpointing,
                                                activation=config.encoder_activation,
                                                output_activation=None)
     elif config.CNN_encoder:
@@ -45,7 +48,8 @@ def build_encoder(config):
                                                                              'strides',
                                                                              'paddings',
                                                                              'poolings',
-                                                                             'batch_normalization']))
+                                                                             'batch_normalization',
+                                                                             'channels_last']))
 
     config.state_encoder = state_encoder
     config.state_dim = state_dim
@@ -57,6 +61,11 @@ class Container(nn.Module):
     def __init__(self):
         super().__init__()
         self.device = None
+        self.flat_tensor = None
+        self.flat_parameters = None
+        self.flat_views = []
+        self.flat_offsets = []
+        self.unflattened_parameters = []
 
     def to(self, *args, **kwargs):
         device, *_ = torch._C._nn._parse_to(*args, **kwargs)
@@ -66,7 +75,53 @@ class Container(nn.Module):
                 if isinstance(module, Container):
                     module.to(device)
             self.device = device
-        return super().to(*args, **kwargs)
+        super().to(*args, **kwargs)
+        if self.flat_tensor is not None and not self.is_flattened():
+            self.flatten_parameters()
+        return self
+
+    def flat_tensors(self):
+        # Parameters first, then floating point buffers (e.g. running statistics),
+        # RNN weights on CUDA stay out since cuDNN keeps them in its own flat buffer
+        # (re-created by nn.RNNBase._apply, e.g. on share_memory)
+        excluded = {id(param) for module in self.modules() if isinstance(module, nn.RNNBase)
+                    for param in module.parameters() if param.is_cuda}
+        params = [param for param in self.parameters() if id(param) not in excluded]
+        buffers = [buffer for buffer in self.buffers() if torch.is_floating_point(buffer)]
+        return params, buffers
+
+    def flatten_parameters(self):
+        # Reallocate parameters and buffers as views into one contiguous tensor, so weight copies,
+        # soft updates and checkpointing of the whole module operate on a single buffer
+        params, buffers = self.flat_tensors()
+        tensors = params + buffers
+        if len(tensors) > 0:
+            flat_tensor = torch.cat([tensor.detach().reshape(-1) for tensor in tensors])
+        else:
+            flat_tensor = torch.zeros(0, device=self.device)
+
+        offset = 0
+        for tensor in tensors:
+            numel = tensor.numel()
+            tensor.data = flat_tensor[offset:offset + numel].view_as(tensor)
+            offset += numel
+
+        self.flat_tensor = flat_tensor
+        self.flat_parameters = flat_tensor[:sum(param.numel() for param in params)]
+        # Byte offsets of the views, which also hold in other processes the tensors are shared with
+        self.flat_views = tensors
+        self.flat_offsets = [tensor.data_ptr() - flat_tensor.data_ptr() for tensor in tensors]
+        self.unflattened_parameters = [param for param in self.parameters()
+                                       if all(param is not other for other in params)]
+        return flat_tensor
+
+    def is_flattened(self):
+        if self.flat_tensor is None:
+            return False
+        # Views are moved out of the flat tensor by device transfers or by cuDNN (nn.RNNBase._apply)
+        data_ptr = self.flat_tensor.data_ptr()
+        return all(tensor.data_ptr() - data_ptr == offset
+                   for tensor, offset in zip(self.flat_views, self.flat_offsets))
 
     def save_model(self, path, key_filter=None):
         state_dict = self.state_dict()
@@ -117,54 +172,60 @@ class VanillaNeuralNetwork(NetworkBase):
 
 
 class GRUHidden(object):
-    def __init__(self, hidden):
-        self.hidden = hidden
+    # Hidden states of all GRU layers concatenated along the last dimension of one tensor,
+    # so indexing, device transfer and concatenation are single tensor operations
+    __slots__ = ('tensor', 'sizes')
+
+    def __init__(self, tensor, sizes):
+        self.tensor = tensor
+        self.sizes = tuple(sizes)
+
+    @staticmethod
+    def from_layers(hiddens):
+        sizes = [hidden.size(-1) for hidden in hiddens]
+        tensor = (hiddens[0] if len(hiddens) == 1 else torch.cat(hiddens, dim=-1))
+        return GRUHidden(tensor=tensor, sizes=sizes)
+
+    @property
+    def hidden(self):
+        if len(self.sizes) == 1:
+            return [self.tensor]
+        return [hidden.contiguous() for hidden in self.tensor.split(self.sizes, dim=-1)]
 
     def __str__(self):
         return str(self.hidden)
 
     def __repr__(self):
-        return repr(self.hidden)
+        return f'GRUHidden(tensor={self.tensor!r}, sizes={self.sizes})'
 
     def __getitem__(self, item):
-        new_hidden = []
-        for h in self.hidden:
-            new_hidden.append(h[item])
-        return GRUHidden(hidden=new_hidden)
+        # Index over leading dimensions only (time and batch)
+        return GRUHidden(tensor=self.tensor[item], sizes=self.sizes)
+
+    def to(self, *args, **kwargs):
+        return GRUHidden(tensor=self.tensor.to(*args, **kwargs), sizes=self.sizes)
 
-    def __getattr__(self, item):
-        attr = getattr(torch.Tensor, item)
+    def cpu(self):
+        return GRUHidden(tensor=self.tensor.cpu(), sizes=self.sizes)
 
-        if callable(attr):
-            self_hidden = self.hidden
+    def float(self):
+        return GRUHidden(tensor=self.tensor.float(), sizes=self.sizes)
 
-            def func(*args, **kwargs):
-                new_hidden = []
-                for h in self_hidden:
-                    new_hidden.append(attr(h, *args, **kwargs))
-                return GRUHidden(hidden=new_hidden)
+    def detach(self):
+        return GRUHidden(tensor=self.tensor.detach(), sizes=self.sizes)
 
-            return func
-        else:
-            new_hidden = []
-            for h in self.hidden:
-                new_hidden.append(getattr(h, item))
-            return GRUHidden(hidden=new_hidden)
+    def unsqueeze(self, dim):
+        return GRUHidden(tensor=self.tensor.unsqueeze(dim=dim), sizes=self.sizes)
 
-    def float(self):
-        new_hidden = []
-        for h in self.hidden:
-            new_hidden.append(torch.FloatTensor(h))
-        return GRUHidden(hidden=new_hidden)
+    def repeat(self, *sizes):
+        return GRUHidden(tensor=self.tensor.repeat(*sizes), sizes=self.sizes)
+
+    def size(self, dim=None):
+        return (self.tensor.size() if dim is None else self.tensor.size(dim))
 
     @staticmethod
     def cat(hiddens, dim=0):
-        hiddens = [hidden.hidden for hidden in hiddens]
-        new_hidden = []
-        for ith_layer_hiddens in zip(*hiddens):
-            ith_layer_hiddens = torch.cat(ith_layer_hiddens, dim=dim)
-            new_hidden.append(ith_layer_hiddens)
-        return GRUHidden(hidden=new_hidden)
+        return GRUHidden(tensor=torch.cat([hidden.tensor for hidden in hiddens], dim=dim), sizes=hiddens[0].sizes)
 
 
 cat_hidden = GRUHidden.cat
@@ -172,9 +233,10 @@ cat_hidden = GRUHidden.cat
 
 class RecurrentNeuralNetwork(NetworkBase):
     def __init__(self, n_dims_before_rnn, n_dims_rnn_hidden, n_dims_after_rnn,
-                 skip_connection=False, trainable_initial_hidden=False,
+                 skip_connection=False, trainable_initial_hidden=False, gradient_checkpointing=None,
                  activation=nn.ReLU(inplace=True), output_activation=None, device=None):
         assert len(n_dims_rnn_hidden) > 0
+        assert gradient_checkpointing is None or gradient_checkpointing > 0
 
         super().__init__()
 
@@ -185,6 +247,9 @@ class RecurrentNeuralNetwork(NetworkBase):
         if skip_connection:
             n_dims_after_rnn[0] += n_dims_before_rnn[-1]
 
+        # Number of time steps per checkpointed chunk (store no activations inside chunks if not None)
+        self.gradient_checkpointing = gradient_checkpointing
+
         self.activation = activation
         self.output_activation = output_activation
 
@@ -219,6 +284,7 @@ class RecurrentNeuralNetwork(NetworkBase):
 
         self.in_features = self.linear_layers_before_rnn.in_features
         self.out_features = self.linear_layers_after_rnn.out_features
+        self.hidden_sizes = tuple(n_dims_rnn_hidden[1:])
 
         self.to(device)
 
@@ -227,24 +293,54 @@ class RecurrentNeuralNetwork(NetworkBase):
             hx = self.initial_hiddens(batch_size=x.size(1))
         assert isinstance(hx, GRUHidden)
 
+        if self.gradient_checkpointing is None or not torch.is_grad_enabled() \
+                or x.size(0) <= self.gradient_checkpointing:
+            return self.forward_chunk(x, hx)
+
+        # Keep only the chunk inputs and the hidden states between chunks for backward,
+        # activations of the MLP blocks and GRU layers are recomputed chunk by chunk
+        outputs = []
+        has = []
+        for chunk in x.split(self.gradient_checkpointing, dim=0):
+            chunk, hx, ha = checkpoint(self.forward_chunk, chunk, hx, use_reentrant=False)
+            outputs.append(chunk)
+            has.append(ha)
+        return torch.cat(outputs, dim=0), hx, GRUHidden.cat(has, dim=0)
+
+    def forward_chunk(self, x, hx):
         identity = x = self.linear_layers_before_rnn(x)
 
         ha = []
         hn = []
-        for i, gru_layer in enumerate(self.gru_layers):
-            hn.append(None)
-            x, hn[i] = gru_layer(x, hx.hidden[i])
+        for gru_layer, h in zip(self.gru_layers, hx.hidden):
+            x, h = gru_layer(x, h)
             ha.append(x)
+            hn.append(h)
 
         if self.skip_connection:
             x = torch.cat([x, identity], dim=-1)
         x = self.linear_layers_after_rnn(x)
-        ha = GRUHidden(hidden=ha)
-        hn = GRUHidden(hidden=hn)
+        ha = GRUHidden.from_layers(ha)
+        hn = GRUHidden.from_layers(hn)
         return x, hn, ha
 
+    def step(self, x, hidden):
+        # Single step inference with GRU cell kernels (weights tied to the GRU layers),
+        # x: (batch_size, in_features), hidden: (batch_size, sum(hidden_sizes)) updated in-place
+        identity = x = self.linear_layers_before_rnn(x)
+
+        for gru_layer, h in zip(self.gru_layers, hidden.split(self.hidden_sizes, dim=-1)):
+            x = torch.gru_cell(x, h, gru_layer.weight_ih_l0, gru_layer.weight_hh_l0,
+                               gru_layer.bias_ih_l0, gru_layer.bias_hh_l0)
+            h.copy_(x)
+
+        if self.skip_connection:
+            x = torch.cat([x, identity], dim=-1)
+        x = self.linear_layers_after_rnn(x)
+        return x
+
     def initial_hiddens(self, batch_size=1):
-        init_hidden = GRUHidden(hidden=list(self.init_hiddens))
+        init_hidden = GRUHidden.from_layers(list(self.init_hiddens))
         init_hidden = init_hidden.to(self.device)
         return init_hidden.repeat(1, batch_size, 1)
 
@@ -252,7 +348,7 @@ class RecurrentNeuralNetwork(NetworkBase):
 class ConvolutionalNeuralNetwork(NetworkBase):
     def __init__(self, image_size, input_channels, n_hidden_channels,
                  kernel_sizes, strides, paddings, poolings,
-                 output_dim=None, headless=False, batch_normalization=False,
+                 output_dim=None, headless=False, batch_normalization=False, channels_last=False,
                  activation=nn.ReLU(inplace=True), output_activation=None, device=None):
         assert len(n_hidden_channels) == len(kernel_sizes)
         assert len(n_hidden_channels) == len(strides)
@@ -288,6 +384,10 @@ class ConvolutionalNeuralNetwork(NetworkBase):
 
         self.max_pooling_layers = nn.ModuleList(list(map(nn.MaxPool2d, poolings)))
 
+        # Convolve in NHWC memory format, the parameters stay in the (flat) NCHW storage
+        # and are converted on the fly
+        self.memory_format = (torch.channels_last if channels_last else torch.contiguous_format)
+
         dummy = torch.zeros(1, input_channels, *image_size)
         with torch.no_grad():
             dummy = self(dummy)
@@ -308,17 +408,27 @@ class ConvolutionalNeuralNetwork(NetworkBase):
 
     def forward(self, x):
         input_size = x.size()
-        x = x.view(-1, *input_size[-3:])
+        x = x.reshape(-1, *input_size[-3:])
+
+        # uint8 images are normalized to [0.0, 1.0] by the weights of the first conv layer
+        scale = 1.0
+        if not torch.is_floating_point(x):
+            scale = 1.0 / 255.0
+            x = x.to(dtype=torch.float32, memory_format=self.memory_format)
+        else:
+            x = x.contiguous(memory_format=self.memory_format)
 
         for i, (conv_layer, max_pooling_layer) in enumerate(zip(self.conv_layers,
                                                                 self.max_pooling_layers)):
-            x = conv_layer(x)
-            if self.batch_normalization:
+            weight, bias = self.conv_parameters(i, scale=(scale if i == 0 else 1.0))
+            x = F.conv2d(x, weight, bias, stride=conv_layer.stride, padding=conv_layer.padding,
+                         dilation=conv_layer.dilation, groups=conv_layer.groups)
+            if self.batch_normalization and self.training:
                 x = self.batch_norm_layers[i](x)
             x = self.activation(x)
             x = max_pooling_layer(x)
 
-        x = x.view(*input_size[:-3], -1)
+        x = x.reshape(*input_size[:-3], -1)
         if hasattr(self, 'linear_layer'):
             x = self.linear_layer(x)
         if self.output_activation is not None:
@@ -326,6 +436,20 @@ class ConvolutionalNeuralNetwork(NetworkBase):
 
         return x
 
+    def conv_parameters(self, i, scale=1.0):
+        # In eval mode (samplers), batch normalization is folded into the conv weights and bias,
+        # so each layer is a single convolution followed by the activation function
+        conv_layer = self.conv_layers[i]
+        weight, bias = conv_layer.weight, conv_layer.bias
+        if self.batch_normalization and not self.training:
+            batch_norm_layer = self.batch_norm_layers[i]
+            factor = batch_norm_layer.weight * torch.rsqrt(batch_norm_layer.running_var + batch_norm_layer.eps)
+            weight = weight * factor.view(-1, 1, 1, 1)
+            bias = (bias - batch_norm_layer.running_mean) * factor + batch_norm_layer.bias
+        if scale != 1.0:
+            weight = weight * scale
+        return weight.contiguous(memory_format=self.memory_format), bias
+
 
 MLP = MultilayerPerceptron = VanillaNN = VanillaNeuralNetwork
 RNN = RecurrentNeuralNetwork
@@ -1,5 +1,4 @@
 import copy
-import glob
 import json
 import os
 import re
@@ -15,6 +14,14 @@ CHECKPOINT_FORMAT = partial(CHECKPOINT_FORMAT.format, prefix='', suffix='')
 CHECKPOINT_PATTERN = re.compile(r'^(.*/)?[\w-]*epoch\((?P<epoch>\d+)\)-reward\((?P<reward>[\-+Ee\d.]+)\)[\w-]*\.pkl$')
 
 
+def to_tensor(array, device=None):
+    array = np.asanyarray(array)
+    if array.dtype == np.uint8:
+        # Keep images in uint8 to reduce transfer volume, they are normalized by the state encoder
+        return torch.from_numpy(array).to(device)
+    return torch.as_tensor(array, dtype=torch.float32, device=device)
+
+
 def clone_network(src_net, device=None):
     if device is None:
         device = getattr(src_net, 'device', None)
@@ -23,6 +30,8 @@ def clone_network(src_net, device=None):
 
     if device is not None:
         dst_net.to(device)
+    if getattr(dst_net, 'flat_tensor', None) is not None and not dst_net.is_flattened():
+        dst_net.flatten_parameters()
 
     return dst_net
 
@@ -33,12 +42,31 @@ def sync_params(src_net, dst_net, soft_tau=1.0):
 
     if soft_tau == 0.0:
         return
-    elif soft_tau == 1.0:
-        for src_param, dst_param in zip(src_net.parameters(), dst_net.parameters()):
+
+    # Flattened networks (see Container.flatten_parameters) are updated with a single kernel,
+    # the parameters outside the flat tensor (if any) are updated one by one
+    src_flat = getattr(src_net, 'flat_parameters', None)
+    dst_flat = getattr(dst_net, 'flat_parameters', None)
+    if src_flat is not None and dst_flat is not None and src_flat.numel() == dst_flat.numel() \
+            and src_net.is_flattened() and dst_net.is_flattened():
+        with torch.no_grad():
+            if soft_tau == 1.0:
+                dst_flat.copy_(src_flat)
+            else:
+                dst_flat.lerp_(src_flat.to(dst_flat.device), soft_tau)
+        src_params, dst_params = src_net.unflattened_parameters, dst_net.unflattened_parameters
+        if len(dst_params) == 0:
+            return
+    else:
+        src_params, dst_params = list(src_net.parameters()), list(dst_net.parameters())
+
+    if soft_tau == 1.0:
+        for src_param, dst_param in zip(src_params, dst_params):
             dst_param.data.copy_(src_param.data)
     else:  # 0.0 < soft_tau < 1.0
-        for src_param, dst_param in zip(src_net.parameters(), dst_net.parameters()):
-            dst_param.data.copy_(dst_param.data * (1.0 - soft_tau) + src_param.data * soft_tau)
+        # In-place Polyak update with multi-tensor kernels (no temporaries)
+        with torch.no_grad():
+            torch._foreach_lerp_(dst_params, src_params, soft_tau)
 
 
 def init_optimizer(optimizer):
@@ -78,17 +106,9 @@ def check_devices(config):
     return devices
 
 
-def get_checkpoint(checkpoint_dir, by='epoch'):
-    try:
-        checkpoints = glob.iglob(os.path.join(checkpoint_dir, '*.pkl'))
-        matches = filter(None, map(CHECKPOINT_PATTERN.match, checkpoints))
-        max_match = max(matches, key=lambda match: float(match.group(by)), default=None)
-        return max_match.group()
-    except AttributeError:
-        return None
-
-
 def check_logging(config):
+    from common.checkpoint import find_checkpoint
+
     os.makedirs(config.log_dir, exist_ok=True)
     os.makedirs(config.checkpoint_dir, exist_ok=True)
 
@@ -102,14 +122,13 @@ def check_logging(config):
         with open(file=os.path.join(directory, 'config.json'), mode='w') as file:
             json.dump(config, file, indent=4, default=formatter)
 
+    initial_checkpoint = None
+    initial_epoch = 0
     if config.mode == 'test' or config.load_checkpoint:
-        initial_checkpoint = get_checkpoint(config.checkpoint_dir, by='epoch')
-    else:
-        initial_checkpoint = None
-    if initial_checkpoint is not None:
-        initial_epoch = int(CHECKPOINT_PATTERN.search(initial_checkpoint).group('epoch'))
-    else:
-        initial_epoch = 0
+        entry = find_checkpoint(config.checkpoint_dir, by='epoch')
+        if entry is not None:
+            initial_checkpoint = entry['path']
+            initial_epoch = entry['epoch']
 
     config.initial_checkpoint = initial_checkpoint
     config.initial_epoch = initial_epoch
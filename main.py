@@ -5,25 +5,12 @@ import os
 import random
 import sys
 
-import matplotlib as mpl
-import numpy as np
-import torch
-import torch.multiprocessing as mp
-import torch.nn as nn
-
 from common.config import Config
-from common.environment import initialize_environment
-from common.network import build_encoder
-from common.utils import check_devices, check_logging
-from sac import build_model, train, test
-
 
-mpl.use('Agg')
 
-try:
-    mp.set_start_method('spawn', force=True)
-except RuntimeError:
-    pass
+# Heavy dependencies (PyTorch, Gym, etc.) are imported after parsing arguments
+# and are not loaded by spawned sampler processes when they re-import this module
+os.environ['MPLBACKEND'] = 'Agg'
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -35,6 +22,12 @@ def get_config():
         except ValueError:
             return device
 
+    def positive_int(value):
+        value = int(value)
+        if value < 1:
+            raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+        return value
+
     parser = argparse.ArgumentParser(description='Train or test Soft Actor-Critic controller.')
     parser.add_argument('--mode', type=str, choices=['train', 'test'], default='train',
                         help='mode (default: train)')
@@ -46,16 +39,24 @@ def get_config():
                         help='environment to train on (default: Pendulum-v0)')
     parser.add_argument('--n-frames', type=int, default=1,
                         help='concatenate original N consecutive observations as a new observation (default: 1)')
+    parser.add_argument('--action-repeat', type=int, default=1, metavar='K',
+                        help='repeat each action for K environment steps and accumulate the rewards '
+                             '(MAX_EPISODE_STEPS counts policy steps) (default: 1)')
     parser.add_argument('--render', action='store_true',
                         help='render the environment')
     parser.add_argument('--vision-observation', action='store_true',
                         help='use rendered images as observation')
     parser.add_argument('--image-size', type=int, default=96, metavar='SIZE',
                         help='image size of vision observation (default: 96)')
+    parser.add_argument('--fused-wrappers', action='store_true',
+                        help='apply action and observation transforms in a single environment wrapper')
     parser.add_argument('--hidden-dims', type=int, default=[], nargs='+', metavar='DIM',
                         help='hidden dimensions of FC controller')
     parser.add_argument('--activation', type=str, choices=['ReLU', 'LeakyReLU'], default='ReLU',
                         help='activation function in controller networks (default: ReLU)')
+    parser.add_argument('--critic-ensemble-size', type=int, default=None, metavar='E',
+                        help='use a fused ensemble of E soft Q networks evaluated in one batched forward pass '
+                             '(use two separate soft Q networks if not present)')
     encoder_group = parser.add_argument_group('state encoder')
     encoder_group.add_argument('--encoder-arch', type=str, choices=['FC', 'RNN', 'CNN'], default='FC',
                                help='architecture of state encoder network (default: FC)')
@@ -65,6 +66,12 @@ def get_config():
     encoder_group.add_argument('--encoder-activation', type=str, choices=['ReLU', 'LeakyReLU'], metavar='ACTIVATION',
                                help='activation function in state encoder networks '
                                     '(use activation function in controller if not present)')
+    encoder_group.add_argument('--target-encoder-update-interval', type=positive_int, default=None, metavar='N',
+                               help='encode next observations of FC and CNN state encoders with a target state '
+                                    'encoder hard updated every N learning updates, and cache its outputs per '
+                                    'transition until the next update (STATE_DIM floats per replay buffer entry '
+                                    'on the training device) (encode next observations with the state encoder '
+                                    'if not present)')
     fc_encoder_group = parser.add_argument_group('FC state encoder')
     fc_encoder_group.add_argument('--encoder-hidden-dims', type=int, default=[], nargs='+', metavar='DIM',
                                   help='hidden dimensions of FC state encoder')
@@ -82,6 +89,21 @@ def get_config():
                                         '(use zeros as initial hidden if not present)')
     rnn_encoder_group.add_argument('--step-size', type=int, default=16,
                                    help='number of continuous steps for update (default: 16)')
+    rnn_encoder_group.add_argument('--burn-in-steps', type=int, default=None, metavar='N_STEPS',
+                                   help='sample windows at arbitrary positions of episodes, initialized from '
+                                        'hidden states stored by samplers every STEP_SIZE steps '
+                                        'and a burn-in prefix of at least N_STEPS steps '
+                                        '(walk episodes from the beginning with carried hidden states if not present)')
+    rnn_encoder_group.add_argument('--gradient-checkpointing', type=int, default=None, metavar='N_STEPS',
+                                   help='recompute activations of RNN state encoder in backward pass '
+                                        'over chunks of N_STEPS time steps, memory grows with '
+                                        'STEP_SIZE / N_STEPS + N_STEPS instead of STEP_SIZE '
+                                        '(store all activations if not present)')
+    rnn_encoder_group.add_argument('--variable-length-segments', action='store_true', default=False,
+                                   help='train on padded and masked segments of at most STEP_SIZE steps, '
+                                        'short episodes and episode tails are used without recomputing steps '
+                                        '(sample episodes of at least STEP_SIZE steps and shift the tail windows '
+                                        'if not present)')
     cnn_encoder_group = parser.add_argument_group('CNN state encoder')
     cnn_encoder_group.add_argument('--encoder-hidden-channels', type=int, default=[], nargs='+', metavar='CHN',
                                    help='channels of hidden conv layers in CNN state encoder')
@@ -95,6 +117,9 @@ def get_config():
                                    help='max pooling kernel size after activation function in CNN state encoder (defaults: 1)')
     cnn_encoder_group.add_argument('--batch-normalization', action='store_true', default=False,
                                    help='use batch normalization in CNN state encoder')
+    cnn_encoder_group.add_argument('--channels-last', action='store_true', default=False,
+                                   help='convolve in channels last (NHWC) memory format in CNN state encoder '
+                                        '(use channels first (NCHW) if not present)')
     parser.add_argument('--max-episode-steps', type=int, default=10000,
                         help='max steps per episode (default: 10000)')
     parser.add_argument('--n-epochs', type=int, default=1000,
@@ -105,10 +130,29 @@ def get_config():
                         help='number of learning updates per epoch (default: 256)')
     parser.add_argument('--batch-size', type=int, default=256,
                         help='batch size (default: 256)')
+    parser.add_argument('--updates-per-batch', type=positive_int, default=1, metavar='K',
+                        help='run K learning updates per training step, FC and CNN state encoders sample '
+                             'one super-batch of K * BATCH_SIZE and update over its minibatches, '
+                             'the RNN state encoder prepares K separate batches of sequences (default: 1)')
+    parser.add_argument('--bf16-autocast', action='store_true',
+                        help='run network forwards of learning updates in bfloat16 mixed precision')
     parser.add_argument('--n-samplers', type=int, default=4,
                         help='number of parallel samplers (default: 4)')
+    parser.add_argument('--async-reset', action='store_true',
+                        help='keep a spare pre-reset environment in each sampler '
+                             'and reset finished environments in background '
+                             '(ignored with --vision-observation, rendering is not thread-safe)')
+    parser.add_argument('--jit-policy', action='store_true',
+                        help='trace the fused state encoder and actor with TorchScript for sampling '
+                             '(fall back to eager mode on failure)')
+    parser.add_argument('--quantize-policy', action='store_true',
+                        help='sample with a dynamically quantized int8 copy of the state encoder and actor '
+                             'on CPU samplers (rebuilt on every weight update)')
     parser.add_argument('--buffer-capacity', type=int, default=1000000, metavar='CAPACITY',
                         help='capacity of replay buffer (default: 1000000)')
+    parser.add_argument('--n-warmup-samples', type=int, default=None, metavar='N_SAMPLES',
+                        help='number of random samples to collect before training '
+                             '(use 10 * BATCH_SIZE (* STEP_SIZE for RNN encoder) if not present)')
     parser.add_argument('--update-sample-ratio', type=float, default=2.0, metavar='RATIO',
                         help='speed ratio of training and sampling '
                              '(sample speed <= training speed / ratio (ratio should be larger than 1.0)) '
@@ -117,6 +161,9 @@ def get_config():
                         help='discount factor for rewards (default: 0.99)')
     parser.add_argument('--soft-tau', type=float, default=0.01, metavar='TAU',
                         help='soft update factor for target networks (default: 0.01)')
+    parser.add_argument('--target-update-interval', type=positive_int, default=1, metavar='N',
+                        help='update target networks every N learning updates '
+                             'with compensated factor 1 - (1 - TAU)^N (default: 1)')
     parser.add_argument('--normalize-rewards', action='store_true',
                         help='normalize rewards for training')
     parser.add_argument('--reward-scale', type=float, default=1.0, metavar='SCALE',
@@ -146,10 +193,23 @@ def get_config():
                         help='save rendered episode videos to TensorBoard logs')
     parser.add_argument('--log-dir', type=str, default=os.path.join(ROOT_DIR, 'logs'),
                         help='folder to save TensorBoard logs')
+    parser.add_argument('--log-interval', type=positive_int, default=10, metavar='N_UPDATES',
+                        help='number of learning updates between two writes of training metrics (default: 10)')
+    parser.add_argument('--log-reductions', type=str, default=['mean'], nargs='+', metavar='REDUCTION',
+                        help="reductions of training metrics over each log interval, "
+                             "any of 'mean', 'min', 'max', 'std' and percentiles 'pNN' (default: mean)")
     parser.add_argument('--checkpoint-dir', type=str, default=os.path.join(ROOT_DIR, 'checkpoints'),
                         help='folder to save checkpoint')
     parser.add_argument('--load-checkpoint', action='store_true',
-                        help='load latest checkpoint in checkpoint dir')
+                        help='resume from the latest checkpoint in checkpoint dir '
+                             '(including optimizer states, target critic and global step)')
+    parser.add_argument('--keep-last', type=int, default=None, metavar='N',
+                        help='keep the last N checkpoints saved every 10 epochs (keep all if not present)')
+    parser.add_argument('--keep-best', type=int, default=0, metavar='K',
+                        help='also keep the best K checkpoints by mean episode reward with --keep-last '
+                             '(default: 0)')
+    parser.add_argument('--refresh-env-spec', action='store_true',
+                        help='probe the environment spec again instead of using the cache in checkpoint dir')
     args = parser.parse_args()
     if len(sys.argv) == 1:
         parser.print_help()
@@ -161,6 +221,13 @@ def get_config():
 
 
 def initialize(config):
+    import numpy as np
+    import torch
+
+    from common.environment import initialize_environment
+    from common.network import build_encoder
+    from common.utils import check_devices, check_logging
+
     random.seed(config.random_seed)
     np.random.seed(config.random_seed)
     torch.manual_seed(config.random_seed)
@@ -173,6 +240,10 @@ def initialize(config):
 
 
 def initialize_hyperparameters(config):
+    import torch.nn as nn
+
+    from common.metrics import check_reduction
+
     config.activation = {
         'ReLU': nn.ReLU(inplace=True),
         'LeakyReLU': nn.LeakyReLU(negative_slope=0.01, inplace=True)
@@ -204,14 +275,27 @@ def initialize_hyperparameters(config):
     config.n_samples_per_update = config.batch_size
     if config.RNN_encoder:
         config.n_samples_per_update *= config.step_size
+    config.n_warmup_samples = (config.n_warmup_samples or 10 * config.n_samples_per_update)
 
     config.critic_lr = (config.critic_lr or config.lr)
     config.actor_lr = (config.actor_lr or config.lr)
     config.alpha_lr = (config.alpha_lr or config.actor_lr)
 
+    config.log_reductions = list(map(check_reduction, config.log_reductions))
+
 
 def main():
     config = get_config()
+
+    import torch.multiprocessing as mp
+
+    from sac import build_model, train, test
+
+    try:
+        mp.set_start_method('spawn', force=True)
+    except RuntimeError:
+        pass
+
     initialize(config)
 
     model = build_model(config)
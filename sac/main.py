@@ -5,75 +5,78 @@ from collections import OrderedDict
 import numpy as np
 import tqdm
 from setproctitle import setproctitle
-from torch.utils.tensorboard import SummaryWriter
-
-from common.utils import CHECKPOINT_FORMAT
 
 
 def train_loop(model, config, update_kwargs):
-    with SummaryWriter(log_dir=os.path.join(config.log_dir, 'trainer'), comment='trainer') as writer:
+    from torch.utils.tensorboard import SummaryWriter
+
+    from common.checkpoint import CheckpointManager
+    from common.metrics import AsyncWriter, MetricsAccumulator
+
+    def episode_stats():
+        n_episodes = model.collector.n_episodes
+        recent_slice = slice(max(n_episodes - 100, n_initial_episodes + 1), n_episodes)
+        return (np.mean(model.collector.episode_rewards[recent_slice]),
+                np.mean(model.collector.episode_steps[recent_slice]))
+
+    with AsyncWriter(SummaryWriter(log_dir=os.path.join(config.log_dir, 'trainer'), comment='trainer')) as writer, \
+            CheckpointManager(config.checkpoint_dir, **config.build_from_keys(['keep_last',
+                                                                               'keep_best'])) as checkpoints:
+        # Metrics stay on device until flushed every log interval
+        metrics = MetricsAccumulator(reductions=config.log_reductions)
+        epoch_metrics = MetricsAccumulator(reductions=['mean'])
+
         n_initial_samples = model.collector.n_total_steps
         n_initial_episodes = model.collector.n_episodes
+        initial_global_step = model.global_step
         while model.collector.n_total_steps == n_initial_samples:
             time.sleep(0.1)
 
         setproctitle(title='trainer')
         for epoch in range(config.initial_epoch + 1, config.n_epochs + 1):
-            epoch_critic_loss = 0.0
-            epoch_actor_loss = 0.0
-            epoch_alpha = 0.0
-            mean_episode_reward = 0.0
-            mean_episode_steps = 0.0
             with tqdm.trange(config.n_updates, desc=f'Training {epoch}/{config.n_epochs}') as pbar:
                 for i in pbar:
                     info = model.update(**update_kwargs)
+                    metrics.update(info, prefix='train/')
+                    epoch_metrics.update(info, prefix='epoch/')
 
                     n_samples = model.collector.n_total_steps
-                    n_episodes = model.collector.n_episodes
-                    buffer_size = model.replay_buffer.size
                     try:
-                        update_sample_ratio = (config.n_samples_per_update * model.global_step) / \
+                        update_sample_ratio = (config.n_samples_per_update
+                                               * (model.global_step - initial_global_step)) / \
                                               (n_samples - n_initial_samples)
                     except ZeroDivisionError:
                         update_sample_ratio = config.update_sample_ratio
-                    recent_slice = slice(max(n_episodes - 100, n_initial_episodes + 1), n_episodes)
-                    mean_episode_reward = np.mean(model.collector.episode_rewards[recent_slice])
-                    mean_episode_steps = np.mean(model.collector.episode_steps[recent_slice])
-                    epoch_critic_loss += (info['critic_loss'] - epoch_critic_loss) / (i + 1)
-                    epoch_actor_loss += (info['actor_loss'] - epoch_actor_loss) / (i + 1)
-                    epoch_alpha += (info['temperature_parameter'] - epoch_alpha) / (i + 1)
-                    for item in info:
-                        writer.add_scalar(tag=f'train/{item}', scalar_value=info[item],
+
+                    if (i + 1) % config.log_interval == 0 or i + 1 == config.n_updates:
+                        mean_episode_reward, mean_episode_steps = episode_stats()
+                        metrics.flush(writer, global_step=model.global_step)
+                        writer.add_scalar(tag='train/mean_episode_reward', scalar_value=mean_episode_reward,
+                                          global_step=model.global_step)
+                        writer.add_scalar(tag='train/mean_episode_steps', scalar_value=mean_episode_steps,
+                                          global_step=model.global_step)
+                        writer.add_scalar(tag='train/buffer_size', scalar_value=model.replay_buffer.size,
                                           global_step=model.global_step)
-                    writer.add_scalar(tag='train/mean_episode_reward', scalar_value=mean_episode_reward,
-                                      global_step=model.global_step)
-                    writer.add_scalar(tag='train/mean_episode_steps', scalar_value=mean_episode_steps,
-                                      global_step=model.global_step)
-                    writer.add_scalar(tag='train/buffer_size', scalar_value=buffer_size,
-                                      global_step=model.global_step)
-                    writer.add_scalar(tag='train/update_sample_ratio', scalar_value=update_sample_ratio,
-                                      global_step=model.global_step)
-                    pbar.set_postfix(OrderedDict([('global_step', model.global_step),
-                                                  ('episode_reward', mean_episode_reward),
-                                                  ('episode_steps', mean_episode_steps),
-                                                  ('n_samples', f'{n_samples:.2E}'),
-                                                  ('update/sample', f'{update_sample_ratio:.1f}')]))
+                        writer.add_scalar(tag='train/update_sample_ratio', scalar_value=update_sample_ratio,
+                                          global_step=model.global_step)
+                        pbar.set_postfix(OrderedDict([('global_step', model.global_step),
+                                                      ('episode_reward', mean_episode_reward),
+                                                      ('episode_steps', mean_episode_steps),
+                                                      ('n_samples', f'{n_samples:.2E}'),
+                                                      ('update/sample', f'{update_sample_ratio:.1f}')]))
                     if update_sample_ratio < config.update_sample_ratio:
                         model.collector.pause()
                     else:
                         model.collector.resume()
 
-            writer.add_scalar(tag='epoch/critic_loss', scalar_value=epoch_critic_loss, global_step=epoch)
-            writer.add_scalar(tag='epoch/actor_loss', scalar_value=epoch_actor_loss, global_step=epoch)
-            writer.add_scalar(tag='epoch/temperature_parameter', scalar_value=epoch_alpha, global_step=epoch)
+            mean_episode_reward, mean_episode_steps = episode_stats()
+            epoch_metrics.flush(writer, global_step=epoch)
             writer.add_scalar(tag='epoch/mean_episode_reward', scalar_value=mean_episode_reward, global_step=epoch)
             writer.add_scalar(tag='epoch/mean_episode_steps', scalar_value=mean_episode_steps, global_step=epoch)
 
             writer.flush()
-            model.save_model(path=os.path.join(config.checkpoint_dir, 'latest.pkl'))
-            if epoch % 10 == 0:
-                checkpoint_name = CHECKPOINT_FORMAT(epoch=epoch, reward=mean_episode_reward)
-                model.save_model(path=os.path.join(config.checkpoint_dir, checkpoint_name))
+            checkpoints.save(model.state_dict(), epoch=epoch, reward=mean_episode_reward,
+                             global_step=model.global_step, keep=(epoch % 10 == 0))
 
 
 def train(model, config):
@@ -83,21 +86,21 @@ def train(model, config):
                                             'adaptive_entropy',
                                             'clip_gradient',
                                             'gamma',
-                                            'soft_tau'])
+                                            'soft_tau',
+                                            'target_update_interval',
+                                            'updates_per_batch',
+                                            'bf16_autocast'])
     if config.RNN_encoder:
-        update_kwargs.update(step_size=config.step_size)
+        update_kwargs.update(config.build_from_keys(['step_size', 'burn_in_steps', 'variable_length_segments']))
     update_kwargs.update(target_entropy=-1.0 * config.action_dim)
 
     print(f'Start parallel sampling using {config.n_samplers} samplers '
           f'at {tuple(map(str, model.collector.devices))}.')
 
     model.collector.eval()
-    while model.replay_buffer.size < 10 * config.n_samples_per_update:
-        model.sample(n_episodes=10 * int(np.ceil(config.n_samples_per_update / config.max_episode_steps)),
-                     max_episode_steps=config.max_episode_steps,
-                     deterministic=False,
-                     random_sample=True,
-                     render=config.render)
+    if model.replay_buffer.size < config.n_warmup_samples:
+        model.warmup(n_samples=config.n_warmup_samples - model.replay_buffer.size,
+                     max_episode_steps=config.max_episode_steps)
 
     model.collector.train()
     model.async_sample(n_episodes=np.inf,
@@ -117,6 +120,8 @@ def train(model, config):
 
 
 def test(model, config):
+    from torch.utils.tensorboard import SummaryWriter
+
     with SummaryWriter(log_dir=config.log_dir) as writer:
         print(f'Start parallel sampling using {config.n_samplers} samplers '
               f'at {tuple(map(str, model.collector.devices))}.')
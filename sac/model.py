@@ -6,10 +6,11 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 
+from common.buffer import TransitionCache
 from common.collector import Collector
 from common.network import Container
-from common.utils import clone_network, sync_params, init_optimizer, clip_grad_norm
-from .network import StateEncoderWrapper, Actor, Critic
+from common.utils import clone_network, sync_params, init_optimizer, clip_grad_norm, to_tensor
+from .network import StateEncoderWrapper, Actor, Critic, EnsembleCritic
 
 
 __all__ = ['build_model', 'Trainer', 'Tester']
@@ -27,7 +28,11 @@ def build_model(config):
                                            'n_samplers',
                                            'buffer_capacity',
                                            'devices',
-                                           'random_seed'])
+                                           'random_seed',
+                                           'async_reset',
+                                           'jit_policy',
+                                           'quantize_policy',
+                                           'critic_ensemble_size'])
     if config.mode == 'train':
         model_kwargs.update(config.build_from_keys(['critic_lr',
                                                     'actor_lr',
@@ -36,8 +41,11 @@ def build_model(config):
 
         if not config.RNN_encoder:
             Model = Trainer
+            model_kwargs.update(config.build_from_keys(['target_encoder_update_interval']))
         else:
             from .rnn.model import Trainer as Model
+            if config.burn_in_steps is not None:
+                model_kwargs.update(hidden_interval=config.step_size)
     else:
         if not config.RNN_encoder:
             Model = Tester
@@ -56,6 +64,12 @@ def build_model(config):
     return model
 
 
+def masked_mean(tensor, mask=None):
+    if mask is None:
+        return tensor.mean()
+    return (tensor * mask).sum() / mask.sum().clamp(min=1.0)
+
+
 class ModelBase(object):
     STATE_ENCODER_WRAPPER = StateEncoderWrapper
     COLLECTOR = Collector
@@ -63,7 +77,8 @@ class ModelBase(object):
     def __init__(self, env_func, env_kwargs, state_encoder,
                  state_dim, action_dim, hidden_dims, activation,
                  initial_alpha, n_samplers, buffer_capacity,
-                 devices, random_seed=0):
+                 devices, random_seed=0, async_reset=False, jit_policy=False, quantize_policy=False,
+                 critic_ensemble_size=None):
         self.devices = itertools.cycle(devices)
         self.model_device = next(self.devices)
 
@@ -74,7 +89,11 @@ class ModelBase(object):
 
         self.state_encoder = self.STATE_ENCODER_WRAPPER(state_encoder)
 
-        self.critic = Critic(state_dim, action_dim, hidden_dims, activation=activation)
+        if critic_ensemble_size is None:
+            self.critic = Critic(state_dim, action_dim, hidden_dims, activation=activation)
+        else:
+            self.critic = EnsembleCritic(state_dim, action_dim, hidden_dims,
+                                         ensemble_size=critic_ensemble_size, activation=activation)
         self.actor = Actor(state_dim, action_dim, hidden_dims, activation=activation)
 
         self.log_alpha = nn.Parameter(torch.tensor(np.log(initial_alpha), dtype=torch.float32),
@@ -87,6 +106,8 @@ class ModelBase(object):
         self.modules.params = nn.ParameterDict({'log_alpha': self.log_alpha})
         self.modules.to(self.model_device)
 
+        for module in (self.state_encoder, self.critic, self.actor):
+            module.flatten_parameters()
         self.state_encoder.share_memory()
         self.actor.share_memory()
         self.collector = self.COLLECTOR(env_func=env_func,
@@ -96,7 +117,10 @@ class ModelBase(object):
                                         n_samplers=n_samplers,
                                         buffer_capacity=buffer_capacity,
                                         devices=self.devices,
-                                        random_seed=random_seed)
+                                        random_seed=random_seed,
+                                        async_reset=async_reset,
+                                        jit_policy=jit_policy,
+                                        quantize_policy=quantize_policy)
 
     def print_info(self, file=None):
         print(f'state_dim = {self.state_dim}', file=file)
@@ -123,6 +147,9 @@ class ModelBase(object):
                                                render, log_episode_video, log_dir)
         return samplers
 
+    def warmup(self, n_samples, max_episode_steps):
+        self.collector.warmup(n_samples, max_episode_steps)
+
     def train(self, mode=True):
         if self.training != mode:
             self.training = mode
@@ -137,22 +164,43 @@ class ModelBase(object):
         self.modules.save_model(path)
 
     def load_model(self, path, strict=True):
-        self.modules.load_model(path, strict=strict)
+        # Load a full training state (see state_dict) or module weights only
+        self.load_state_dict(torch.load(path, map_location=self.model_device), strict=strict)
+
+    def state_dict(self):
+        return {'modules': self.modules.state_dict()}
+
+    def load_state_dict(self, state_dict, strict=True):
+        if 'modules' in state_dict:
+            state_dict = state_dict['modules']
+        self.modules.load_state_dict(state_dict, strict=strict)
 
 
 class Trainer(ModelBase):
     def __init__(self, env_func, env_kwargs, state_encoder,
                  state_dim, action_dim, hidden_dims, activation,
                  initial_alpha, critic_lr, actor_lr, alpha_lr, weight_decay,
-                 n_samplers, buffer_capacity, devices, random_seed=0):
+                 n_samplers, buffer_capacity, devices, random_seed=0, async_reset=False, jit_policy=False,
+                 quantize_policy=False, critic_ensemble_size=None, target_encoder_update_interval=None):
         super().__init__(env_func, env_kwargs, state_encoder,
                          state_dim, action_dim, hidden_dims, activation,
                          initial_alpha, n_samplers, buffer_capacity,
-                         devices, random_seed)
+                         devices, random_seed, async_reset, jit_policy, quantize_policy, critic_ensemble_size)
 
         self.target_critic = clone_network(src_net=self.critic, device=self.model_device)
         self.target_critic.eval().requires_grad_(False)
 
+        # Next observations are encoded by a target state encoder that lags the state encoder
+        # by up to N updates, its outputs are cached per transition until the next hard update
+        self.target_encoder_update_interval = target_encoder_update_interval
+        self.target_state_encoder = None
+        self.next_state_cache = None
+        if target_encoder_update_interval is not None:
+            self.target_state_encoder = clone_network(src_net=self.state_encoder, device=self.model_device)
+            self.target_state_encoder.eval().requires_grad_(False)
+            self.next_state_cache = TransitionCache(capacity=buffer_capacity, item_size=state_dim,
+                                                    device=self.model_device)
+
         self.critic_criterion = nn.MSELoss()
 
         self.global_step = 0
@@ -170,39 +218,66 @@ class Trainer(ModelBase):
     def update_sac(self, state, action, reward, next_state, done,
                    normalize_rewards=True, reward_scale=1.0,
                    adaptive_entropy=True, target_entropy=-2.0,
-                   clip_gradient=False, gamma=0.99, soft_tau=0.01, epsilon=1E-6):
+                   clip_gradient=False, gamma=0.99, soft_tau=0.01, epsilon=1E-6,
+                   target_update_interval=1, bf16_autocast=False, mask=None):
+        # Losses and reward statistics are averaged over valid items only if a mask is given
+        # (padded steps of variable-length segments)
         # Normalize rewards
         if normalize_rewards:
             with torch.no_grad():
-                reward = reward_scale * (reward - reward.mean()) / (reward.std() + epsilon)
+                if mask is None:
+                    reward = reward_scale * (reward - reward.mean()) / (reward.std() + epsilon)
+                else:
+                    reward_mean = masked_mean(reward, mask)
+                    reward_std = masked_mean((reward - reward_mean).square(), mask).sqrt()
+                    reward = reward_scale * (reward - reward_mean) / (reward_std + epsilon)
 
         # Update temperature parameter
-        new_action, log_prob, _ = self.actor.evaluate(state)
+        with self.autocast(enabled=bf16_autocast):
+            new_action, log_prob, _ = self.actor.evaluate(state)
         if adaptive_entropy:
-            alpha_loss = -(self.log_alpha * (log_prob + target_entropy).detach()).mean()
+            alpha_loss = -masked_mean(self.log_alpha * (log_prob + target_entropy).detach(), mask)
             self.alpha_optimizer.zero_grad()
             alpha_loss.backward()
             self.alpha_optimizer.step()
         with torch.no_grad():
             alpha = self.log_alpha.exp()
 
+        # Evaluate Q values for critic loss and actor loss in one pass,
+        # Q values of new actions only back-propagate to new actions (stop gradient to critic and state encoder)
+        with self.autocast(enabled=bf16_autocast):
+            predicted_q_values, predicted_new_q_values = self.critic.evaluate(state, action, new_action)
+            with torch.no_grad():
+                new_next_action, next_log_prob, _ = self.actor.evaluate(next_state)
+                target_q_values = self.target_critic(next_state, new_next_action)
+        predicted_q_values = [predicted_q_value.float() for predicted_q_value in predicted_q_values]
+        predicted_new_q_values = [predicted_new_q_value.float() for predicted_new_q_value in predicted_new_q_values]
+
+        # With more than two soft Q networks, the target takes the min over a random pair of them
+        # and the actor loss the mean over all of them (as REDQ), the min over all would be overly pessimistic
+        if len(target_q_values) > 2:
+            pair = torch.randperm(len(target_q_values))[:2].tolist()
+            target_q_values = [target_q_values[i] for i in pair]
+
         # Train Q function
-        predicted_q_value_1, predicted_q_value_2 = self.critic(state, action)
         with torch.no_grad():
-            new_next_action, next_log_prob, _ = self.actor.evaluate(next_state)
-
-            target_q_min = torch.min(*self.target_critic(next_state, new_next_action))
+            target_q_min = torch.stack(target_q_values).float().min(dim=0)[0]
             target_q_min -= alpha * next_log_prob
             target_q_value = reward + (1 - done) * gamma * target_q_min
-        critic_loss_1 = self.critic_criterion(predicted_q_value_1, target_q_value)
-        critic_loss_2 = self.critic_criterion(predicted_q_value_2, target_q_value)
-        critic_loss = (critic_loss_1 + critic_loss_2) / 2.0
+        if mask is None:
+            critic_loss = sum(self.critic_criterion(predicted_q_value, target_q_value)
+                              for predicted_q_value in predicted_q_values) / len(predicted_q_values)
+        else:
+            critic_loss = sum(masked_mean((predicted_q_value - target_q_value).square(), mask)
+                              for predicted_q_value in predicted_q_values) / len(predicted_q_values)
 
         # Train policy function
-        predicted_new_q_value = torch.min(*self.critic(state, new_action))
-        predicted_new_q_value_critic_grad_only = torch.min(*self.critic(state, new_action.detach()))
-        actor_loss = (alpha * log_prob - predicted_new_q_value).mean()
-        actor_loss_unbiased = actor_loss + predicted_new_q_value_critic_grad_only.mean()
+        if len(predicted_new_q_values) > 2:
+            predicted_new_q_value = torch.stack(predicted_new_q_values).mean(dim=0)
+        else:
+            predicted_new_q_value = torch.stack(predicted_new_q_values).min(dim=0)[0]
+        actor_loss = masked_mean(alpha * log_prob - predicted_new_q_value, mask)
+        actor_loss_unbiased = actor_loss + masked_mean(predicted_new_q_value.detach(), mask)
 
         loss = critic_loss + self.actor_loss_weight * actor_loss_unbiased
         self.optimizer.zero_grad()
@@ -211,49 +286,131 @@ class Trainer(ModelBase):
             clip_grad_norm(self.optimizer)
         self.optimizer.step()
 
-        # Soft update the target value net
-        sync_params(src_net=self.critic, dst_net=self.target_critic, soft_tau=soft_tau)
+        # Soft update the target value net every N steps with compensated tau: 1 - (1 - tau)^N
+        if (self.global_step + 1) % target_update_interval == 0:
+            sync_params(src_net=self.critic, dst_net=self.target_critic,
+                        soft_tau=1.0 - (1.0 - soft_tau) ** target_update_interval)
 
         self.global_step += 1
 
+        # Metrics are kept on device, see aggregate_info
         info = {
-            'critic_loss': critic_loss.item(),
-            'actor_loss': actor_loss.item(),
-            'temperature_parameter': alpha.item()
+            'critic_loss': critic_loss.detach(),
+            'actor_loss': actor_loss.detach(),
+            'temperature_parameter': alpha
         }
         return info
 
     def update(self, batch_size, normalize_rewards=True, reward_scale=1.0,
                adaptive_entropy=True, target_entropy=-2.0,
-               clip_gradient=False, gamma=0.99, soft_tau=0.01, epsilon=1E-6):
+               clip_gradient=False, gamma=0.99, soft_tau=0.01, epsilon=1E-6,
+               target_update_interval=1, updates_per_batch=1, bf16_autocast=False):
         self.train()
 
-        # size: (batch_size, item_size)
-        state, action, reward, next_state, done = self.prepare_batch(batch_size)
+        # Sample and transfer one super-batch, then update over its minibatches
+        # size: (updates_per_batch * batch_size, item_size)
+        batch = self.sample_batch(updates_per_batch * batch_size, return_keys=(self.target_state_encoder is not None))
+
+        infos = []
+        for minibatch in zip(*(item.split(batch_size) for item in batch)):
+            # size: (batch_size, item_size)
+            with self.autocast(enabled=bf16_autocast):
+                state, action, reward, next_state, done = self.encode_batch(*minibatch)
+
+            infos.append(self.update_sac(state, action, reward, next_state, done,
+                                         normalize_rewards, reward_scale,
+                                         adaptive_entropy, target_entropy,
+                                         clip_gradient, gamma, soft_tau, epsilon,
+                                         target_update_interval, bf16_autocast))
+
+            if self.target_state_encoder is not None and self.global_step % self.target_encoder_update_interval == 0:
+                self.update_target_encoder()
+
+        return self.aggregate_info(infos)
+
+    def autocast(self, enabled=True):
+        # Network forwards in bfloat16, the temperature parameter, log-probabilities and targets stay in float32
+        return torch.autocast(device_type=self.model_device.type, dtype=torch.bfloat16, enabled=enabled)
 
-        return self.update_sac(state, action, reward, next_state, done,
-                               normalize_rewards, reward_scale,
-                               adaptive_entropy, target_entropy,
-                               clip_gradient, gamma, soft_tau, epsilon)
+    @staticmethod
+    def aggregate_info(infos):
+        # Average metrics on device without synchronization, see common.metrics.MetricsAccumulator
+        return {key: torch.stack([info[key] for info in infos]).mean() for key in infos[0]}
 
     def prepare_batch(self, batch_size):
         # size: (batch_size, item_size)
-        observation, action, reward, next_observation, done \
-            = tuple(map(lambda tensor: torch.FloatTensor(tensor).to(self.model_device),
-                        self.replay_buffer.sample(batch_size)))
+        return self.encode_batch(*self.sample_batch(batch_size))
 
+    def sample_batch(self, batch_size, return_keys=False):
+        # size: (batch_size, item_size)
+        batch = self.replay_buffer.sample(batch_size, return_keys=return_keys)
+        if return_keys:
+            *batch, keys = batch
+            return (*map(lambda tensor: to_tensor(tensor, device=self.model_device), batch),
+                    torch.from_numpy(keys).to(self.model_device))
+        return tuple(map(lambda tensor: to_tensor(tensor, device=self.model_device), batch))
+
+    def encode_batch(self, observation, action, reward, next_observation, done, keys=None):
         state = self.state_encoder(observation)
         with torch.no_grad():
-            next_state = self.state_encoder(next_observation)
+            if keys is None:
+                next_state = self.state_encoder(next_observation)
+            else:
+                next_state = self.encode_next_observation(next_observation, keys)
 
         # size: (batch_size, item_size)
         return state, action, reward, next_state, done
 
-    def load_model(self, path, strict=True):
-        super().load_model(path=path, strict=strict)
-        self.target_critic.load_state_dict(self.critic.state_dict())
+    @torch.no_grad()
+    def encode_next_observation(self, next_observation, keys):
+        # Encode only the next observations of transitions without a cached target encoder output
+        hits, next_state = self.next_state_cache.lookup(keys)
+        misses = torch.nonzero(~hits).squeeze(dim=1)
+        if len(misses) > 0:
+            encoded = self.target_state_encoder(next_observation[misses]).float()
+            next_state[misses] = encoded
+            self.next_state_cache.update(keys[misses], encoded)
+        return next_state
+
+    def update_target_encoder(self):
+        # Hard update (parameters and batch normalization statistics), the cached outputs are stale
+        sync_params(src_net=self.state_encoder, dst_net=self.target_state_encoder)
+        with torch.no_grad():
+            for src_buffer, dst_buffer in zip(self.state_encoder.buffers(), self.target_state_encoder.buffers()):
+                dst_buffer.copy_(src_buffer)
+        self.next_state_cache.clear()
+
+    def state_dict(self):
+        # Full training state for resuming, see common.checkpoint.CheckpointManager
+        state_dict = {
+            'modules': self.modules.state_dict(),
+            'target_critic': self.target_critic.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'alpha_optimizer': self.alpha_optimizer.state_dict(),
+            'global_step': self.global_step
+        }
+        if self.target_state_encoder is not None:
+            state_dict['target_state_encoder'] = self.target_state_encoder.state_dict()
+        return state_dict
+
+    def load_state_dict(self, state_dict, strict=True):
+        super().load_state_dict(state_dict, strict=strict)
+        if 'target_critic' in state_dict:
+            self.target_critic.load_state_dict(state_dict['target_critic'])
+            self.optimizer.load_state_dict(state_dict['optimizer'])
+            self.alpha_optimizer.load_state_dict(state_dict['alpha_optimizer'])
+            self.global_step = state_dict['global_step']
+        else:
+            self.target_critic.load_state_dict(self.critic.state_dict())
         self.target_critic.eval().requires_grad_(False)
 
+        if self.target_state_encoder is not None:
+            if 'target_state_encoder' in state_dict:
+                self.target_state_encoder.load_state_dict(state_dict['target_state_encoder'])
+                self.next_state_cache.clear()
+            else:
+                self.update_target_encoder()
+
 
 class Tester(ModelBase):
     def __init__(self, *args, **kwargs):
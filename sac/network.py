@@ -1,17 +1,20 @@
 import itertools
+import warnings
 
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import torch.nn as nn
 from torch.distributions import Normal
+from torch.func import functional_call
 
 from common.network import Container, MultilayerPerceptron
+from common.utils import to_tensor
 
 
 __all__ = [
     'StateEncoderWrapper',
-    'Actor', 'Critic'
+    'Actor', 'Critic', 'EnsembleCritic',
+    'EagerPolicy', 'FusedPolicy'
 ]
 
 LOG_STD_MIN = np.log(1E-8)
@@ -33,7 +36,7 @@ class StateEncoderWrapper(Container):
 
     @torch.no_grad()
     def encode(self, observation):
-        observation = torch.FloatTensor(observation).unsqueeze(dim=0).to(self.device)
+        observation = to_tensor(observation, device=self.device).unsqueeze(dim=0)
         encoded = self(observation)
         encoded = encoded.cpu().numpy()[0]
         return encoded
@@ -41,6 +44,9 @@ class StateEncoderWrapper(Container):
     def reset(self):
         pass
 
+    def build_policy(self, actor, jit=False):
+        return FusedPolicy(state_encoder=self, actor=actor, jit=jit)
+
     def __getattr__(self, name):
         try:
             return super().__getattr__(name)
@@ -70,6 +76,8 @@ class DimensionScaler(Container):
         return self.scaler(action)
 
     def plot(self):
+        import matplotlib.pyplot as plt
+
         input_dim = self.input_dim
         output_dim = self.output_dim
 
@@ -184,7 +192,8 @@ class PolicyNetwork(MultilayerPerceptron):
         self.to(device)
 
     def forward(self, state):
-        mean, log_std = super().forward(state).chunk(chunks=2, dim=-1)
+        # Distribution parameters are in float32 (also under autocast)
+        mean, log_std = super().forward(state).float().chunk(chunks=2, dim=-1)
         log_std = torch.clamp(log_std, min=self.log_std_min, max=self.log_std_max)
         std = torch.exp(log_std)
         return mean, std
@@ -230,5 +239,188 @@ class Critic(Container):
         q_value_2 = self.soft_q_net_2(state, action)
         return q_value_1, q_value_2
 
+    def evaluate(self, state, action, new_action):
+        # Q values of new actions only back-propagate to new actions (critic parameters and states are detached),
+        # the detached parameters are passed to a functional call, the module itself is left untouched
+        q_values = self(state, action)
+        params = {name: param.detach() for name, param in self.named_parameters()}
+        new_q_values = functional_call(self, params, (state.detach(), new_action))
+        return q_values, new_q_values
+
+
+class EnsembleCritic(Container):
+    def __init__(self, state_dim, action_dim, hidden_dims, ensemble_size=2,
+                 activation=nn.ReLU(inplace=True), device=None):
+        super().__init__()
+
+        self.state_dim = state_dim
+        self.action_dim = action_dim
+        self.scaled_action_dim = scaled_action_dim = max(state_dim, action_dim)
+        self.ensemble_size = ensemble_size
+
+        self.activation = activation
+
+        # Weights of all soft Q networks are stacked in shape (ensemble_size, in_features, out_features)
+        # and evaluated with batched matrix multiplications
+        self.scaler_weight = nn.Parameter(torch.zeros(ensemble_size, action_dim, scaled_action_dim))
+        self.scaler_bias = nn.Parameter(torch.zeros(ensemble_size, 1, scaled_action_dim))
+        with torch.no_grad():
+            for _, i, o in zip(range(max(action_dim, scaled_action_dim)),
+                               itertools.cycle(range(action_dim)),
+                               itertools.cycle(range(scaled_action_dim))):
+                self.scaler_weight[:, i, o] = 1.0
+
+        n_dims = [state_dim + scaled_action_dim, *hidden_dims, 1]
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for i in range(len(n_dims) - 1):
+            # Same initialization as nn.Linear
+            bound = 1 / np.sqrt(n_dims[i])
+            weight = nn.Parameter(torch.Tensor(ensemble_size, n_dims[i], n_dims[i + 1]), requires_grad=True)
+            bias = nn.Parameter(torch.Tensor(ensemble_size, 1, n_dims[i + 1]), requires_grad=True)
+            nn.init.uniform_(weight, -bound, bound)
+            nn.init.uniform_(bias, -bound, bound)
+            self.weights.append(weight)
+            self.biases.append(bias)
+
+        self.to(device)
+
+    def forward(self, state, action):
+        batch_shape = state.size()[:-1]
+        state = state.reshape(1, -1, self.state_dim).expand(self.ensemble_size, -1, -1)
+        action = action.reshape(1, -1, self.action_dim).expand(self.ensemble_size, -1, -1)
+
+        q_values = self.stacked_forward(state, action,
+                                        self.scaler_weight, self.scaler_bias, self.weights, self.biases)
+
+        return q_values.view(self.ensemble_size, *batch_shape, 1).unbind(dim=0)
+
+    def evaluate(self, state, action, new_action):
+        # Evaluate Q values of (state, action) and (state, new_action) in one batched forward pass,
+        # Q values of new actions only back-propagate to new actions (critic parameters and states are detached)
+        def stack(param):
+            return torch.cat([param, param.detach()], dim=0)
+
+        batch_shape = state.size()[:-1]
+        state = state.reshape(1, -1, self.state_dim)
+        state = torch.cat([state.expand(self.ensemble_size, -1, -1),
+                           state.detach().expand(self.ensemble_size, -1, -1)], dim=0)
+        action = torch.cat([action.reshape(1, -1, self.action_dim).expand(self.ensemble_size, -1, -1),
+                            new_action.reshape(1, -1, self.action_dim).expand(self.ensemble_size, -1, -1)], dim=0)
+
+        q_values = self.stacked_forward(state, action,
+                                        stack(self.scaler_weight), stack(self.scaler_bias),
+                                        list(map(stack, self.weights)), list(map(stack, self.biases)))
+
+        q_values, new_q_values = q_values.view(2, self.ensemble_size, *batch_shape, 1).unbind(dim=0)
+        return q_values.unbind(dim=0), new_q_values.unbind(dim=0)
+
+    def stacked_forward(self, state, action, scaler_weight, scaler_bias, weights, biases):
+        # size: (n_stacks, batch_size, item_size)
+        x = torch.cat([state, torch.baddbmm(scaler_bias, action, scaler_weight)], dim=-1)
+        n_layers = len(weights)
+        for i, (weight, bias) in enumerate(zip(weights, biases)):
+            x = torch.baddbmm(bias, x, weight)
+            if i < n_layers - 1:
+                x = self.activation(x)
+        return x
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Map checkpoints of Critic (separate networks soft_q_net_1, soft_q_net_2, ...) to stacked weights
+        net_prefixes = [f'{prefix}soft_q_net_{e + 1}.' for e in range(self.ensemble_size)]
+        n_nets = len({key[len(prefix):].split('.')[0] for key in state_dict
+                      if key.startswith(f'{prefix}soft_q_net_')})
+        if n_nets > 0:
+            if n_nets != self.ensemble_size:
+                raise ValueError(f'cannot load a checkpoint of {n_nets} separate soft Q networks '
+                                 f'into an ensemble critic of size {self.ensemble_size}')
+
+            def stack(key, transform):
+                return torch.stack([transform(state_dict.pop(f'{net_prefix}{key}')) for net_prefix in net_prefixes])
+
+            state_dict[f'{prefix}scaler_weight'] = stack('action_scaler.scaler.weight', torch.t)
+            state_dict[f'{prefix}scaler_bias'] = stack('action_scaler.scaler.bias', torch.atleast_2d)
+            for i in range(len(self.weights)):
+                state_dict[f'{prefix}weights.{i}'] = stack(f'linear_layers.{i}.weight', torch.t)
+                state_dict[f'{prefix}biases.{i}'] = stack(f'linear_layers.{i}.bias', torch.atleast_2d)
+
+        scaler_weight = state_dict.get(f'{prefix}scaler_weight')
+        if scaler_weight is not None and scaler_weight.size(0) != self.ensemble_size:
+            raise ValueError(f'cannot load a checkpoint of an ensemble critic of size {scaler_weight.size(0)} '
+                             f'into an ensemble critic of size {self.ensemble_size}')
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class EagerPolicy(object):
+    def __init__(self, state_encoder, actor):
+        self.state_encoder = state_encoder
+        self.actor = actor
+
+    def get_action(self, observation, deterministic=False):
+        state = self.state_encoder.encode(observation)
+        return self.actor.get_action(state, deterministic=deterministic)
+
+
+class FusedPolicy(nn.Module):
+    # State encoder and actor in one module invoked once per sampler step,
+    # the parameters are shared with the original networks, so weight synchronization applies directly
+    def __init__(self, state_encoder, actor, jit=False):
+        super().__init__()
+
+        self.state_encoder = state_encoder
+        self.actor = actor
+        self.device = actor.device
+
+        self.jit = jit
+        self.traced = None
+        self.observation = None
+        self.noise = torch.zeros(1, device=self.device)
+        self.zero = torch.zeros(1, device=self.device)
+
+    def forward(self, observation, noise):
+        mean, std = self.actor(self.state_encoder(observation))
+        return torch.tanh(mean + std * noise)
+
+    def build(self, observation):
+        dtype = (torch.uint8 if observation.dtype == np.uint8 else torch.float32)
+        self.observation = torch.zeros((1, *observation.shape), dtype=dtype, device=self.device)
+        if self.jit:
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', category=FutureWarning)
+                    self.traced = torch.jit.trace(self, (self.observation, self.noise), check_trace=False)
+            except Exception as e:
+                warnings.warn(f'Failed to trace the policy with TorchScript, fall back to eager mode: {e}')
+
+    @torch.no_grad()
+    def get_action(self, observation, deterministic=False):
+        observation = np.asanyarray(observation)
+        if self.observation is None:
+            self.build(observation)
+        self.observation.copy_(torch.from_numpy(observation))
+
+        # Same noise as get_action: a single standard normal sample shared across action dimensions
+        noise = (self.zero if deterministic else self.noise.normal_())
+        if self.traced is not None:
+            action = self.traced(self.observation, noise)
+        else:
+            action = self(self.observation, noise)
+        return action.cpu().numpy()[0]
+
+    @torch.no_grad()
+    def deterministic_actions(self, observations):
+        return self(to_tensor(np.stack(observations), device=self.device), self.zero)
+
+    def quantized(self):
+        # Copy with dynamically quantized int8 linear layers (CPU only), rebuild it when weights are updated
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            from torch.ao.quantization import quantize_dynamic
+
+            state_encoder, actor = [quantize_dynamic(module, qconfig_spec={nn.Linear}, dtype=torch.qint8)
+                                    for module in (self.state_encoder, self.actor)]
+        return FusedPolicy(state_encoder=state_encoder, actor=actor, jit=self.jit)
+
 
 Actor = PolicyNetwork
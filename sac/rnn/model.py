@@ -5,7 +5,8 @@ import numpy as np
 import torch
 
 from common.collector import EpisodeCollector
-from common.network import cat_hidden
+from common.network import GRUHidden, cat_hidden
+from common.utils import to_tensor
 from .network import StateEncoderWrapper
 from ..model import Trainer as OriginalTrainer, Tester as OriginalTester
 
@@ -13,30 +14,64 @@ from ..model import Trainer as OriginalTrainer, Tester as OriginalTester
 __all__ = ['Trainer', 'Tester']
 
 
+def pad_segment(item, step_size):
+    # Right-pad a segment of an episode item with zeros to step_size steps
+    # size: (step_size, item_size)
+    if len(item) == step_size:
+        return item
+    padded = np.zeros(shape=(step_size, *item.shape[1:]), dtype=item.dtype)
+    padded[:len(item)] = item
+    return padded
+
+
 class Trainer(OriginalTrainer):
     STATE_ENCODER_WRAPPER = StateEncoderWrapper
     COLLECTOR = EpisodeCollector
 
-    def update(self, batch_size, step_size=16,
+    def __init__(self, *args, hidden_interval=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Samplers store encoder hidden states every hidden_interval steps for burn-in replay
+        self.hidden_interval = hidden_interval
+        self.collector.hidden_interval = hidden_interval
+
+    def update(self, batch_size, step_size=16, burn_in_steps=None,
                normalize_rewards=True, reward_scale=1.0,
                adaptive_entropy=True, target_entropy=-2.0,
-               clip_gradient=False, gamma=0.99, soft_tau=0.01, epsilon=1E-6):
+               clip_gradient=False, gamma=0.99, soft_tau=0.01, epsilon=1E-6,
+               target_update_interval=1, updates_per_batch=1, bf16_autocast=False,
+               variable_length_segments=False):
         self.train()
 
-        # size: (batch_size * step_size, item_size)
-        state, action, reward, next_state, done = self.prepare_batch(batch_size, step_size=step_size)
-
-        return self.update_sac(state, action, reward, next_state, done,
-                               normalize_rewards, reward_scale,
-                               adaptive_entropy, target_entropy,
-                               clip_gradient, gamma, soft_tau, epsilon)
-
-    def prepare_batch(self, batch_size, step_size=16):
+        # Windows carry hidden states from the episode cache (or burn-in), so each update prepares its own batch
+        infos = []
+        for _ in range(updates_per_batch):
+            # size: (batch_size * step_size, item_size)
+            with self.autocast(enabled=bf16_autocast):
+                if burn_in_steps is None:
+                    state, action, reward, next_state, done, mask \
+                        = self.prepare_batch(batch_size, step_size, variable_length_segments)
+                else:
+                    state, action, reward, next_state, done, mask \
+                        = self.prepare_burn_in_batch(batch_size, step_size, burn_in_steps, variable_length_segments)
+
+            infos.append(self.update_sac(state, action, reward, next_state, done,
+                                         normalize_rewards, reward_scale,
+                                         adaptive_entropy, target_entropy,
+                                         clip_gradient, gamma, soft_tau, epsilon,
+                                         target_update_interval, bf16_autocast, mask))
+
+        return self.aggregate_info(infos)
+
+    def prepare_batch(self, batch_size, step_size=16, variable_length_segments=False):
+        # With variable-length segments, episodes are walked in disjoint segments of at most step_size steps,
+        # the segments are right-padded with zeros and masked (the padded steps are never recomputed),
+        # otherwise the last window of an episode is shifted to overlap the previous one
         if len(self.episode_cache) < batch_size:
             episodes, lengths = self.replay_buffer.sample(batch_size - len(self.episode_cache),
-                                                          min_length=step_size)
+                                                          min_length=(1 if variable_length_segments else step_size))
             for episode, length in zip(episodes, lengths):
-                observation, action, reward, done = episode
+                observation, action, reward, done, *_ = episode
                 next_observation = np.zeros_like(observation)
                 next_observation[:-1] = observation[1:]
                 episode = [observation, action, reward, next_observation, done]
@@ -56,12 +91,11 @@ class Trainer(OriginalTrainer):
             hiddens.append(hidden)
 
             # size: (step_size, item_size)
-            batch.append([torch.FloatTensor(item[offset:offset + step_size]).to(self.model_device)
-                          for item in episode])
+            batch.append([pad_segment(item[offset:offset + step_size], step_size) for item in episode])
 
         # size: (step_size, batch_size, item_size)
         observation, action, reward, next_observation, done \
-            = tuple(map(lambda tensors: torch.stack(tensors, dim=1), zip(*batch)))
+            = [to_tensor(np.stack(items, axis=1), device=self.model_device).float() for items in zip(*batch)]
         hidden = cat_hidden(hiddens, dim=1).to(self.model_device)
 
         # size: (step_size, batch_size, item_size)
@@ -72,26 +106,137 @@ class Trainer(OriginalTrainer):
             next_state_last, _, _ = self.state_encoder(next_observation_last, hidden_last)
 
             # size: (step_size, batch_size, item_size)
-            next_state = torch.cat([state[:-1].detach(), next_state_last], dim=0)
+            # (the state after the last valid step of a padded segment encodes the zero next observation)
+            next_state = torch.cat([state[1:].detach(), next_state_last], dim=0)
+
+        # Gather hidden states to continue the episodes and transfer them at once,
+        # the last step of hidden_all is hidden_last
+        # size: (batch_size, hidden_size)
+        if variable_length_segments:
+            time_indices = [step_size - 1] * batch_size
+        else:
+            time_indices = [(step_size - 1 if offset + step_size <= length else offset + step_size - length - 1)
+                            for offset, length in zip(offsets, lengths)]
+        next_hiddens = hidden_all[time_indices, list(range(batch_size))].detach().cpu()
+
+        # size: (step_size, batch_size, 1)
+        mask = None
+        if variable_length_segments:
+            mask = (torch.arange(step_size).unsqueeze(dim=1)
+                    < torch.LongTensor(lengths) - torch.LongTensor(offsets) + step_size)
+            mask = mask.unsqueeze(dim=-1).float().to(self.model_device)
 
         for i in reversed(range(batch_size)):
             episode, length, offset = episodes.pop(), lengths.pop(), offsets.pop()
-            if offset == length:
+            if offset >= length:
                 continue
 
-            if offset + step_size <= length:
-                hidden = hidden_last[:, i].unsqueeze(dim=0)
-            else:  # offset + step_size > length
-                hidden = hidden_all[offset + step_size - length - 1, i].unsqueeze(dim=0).unsqueeze(dim=0)
+            if offset + step_size > length and not variable_length_segments:
                 offset = length - step_size
-            self.episode_cache.appendleft((episode, length, offset, hidden.detach().cpu()))
+            self.episode_cache.appendleft((episode, length, offset, next_hiddens[i].unsqueeze(dim=0).unsqueeze(dim=0)))
 
         # size: (batch_size * step_size, item_size)
         state, action, reward, next_state, done \
             = tuple(map(lambda x: x.view(batch_size * step_size, -1),
                         [state, action, reward, next_state, done]))
+        if mask is not None:
+            mask = mask.view(batch_size * step_size, 1)
+
+        return state, action, reward, next_state, done, mask
+
+    def prepare_burn_in_batch(self, batch_size, step_size=16, burn_in_steps=0, variable_length_segments=False):
+        # Windows are sampled uniformly from episodes, each is initialized from the latest stored hidden state
+        # before its burn-in prefix (or from the initial hidden if there is none, e.g. for warmup episodes)
+        episodes, lengths = self.replay_buffer.sample(batch_size,
+                                                      min_length=(1 if variable_length_segments else step_size))
+        # The live initial hidden (trainable with --trainable-hidden) starts the windows at the episode beginnings,
+        # stored and burned-in hidden states are detached
+        # size: (1, hidden_size)
+        live_initial_hidden = self.state_encoder.initial_hiddens().tensor[0]
+        initial_hidden = live_initial_hidden[0].detach().cpu().numpy()
+
+        windows = []
+        burn_ins = []
+        hiddens = []
+        at_beginnings = []
+        for episode, length in zip(episodes, lengths):
+            observation, action, reward, done, *stored_hiddens = episode
+
+            start = np.random.randint(max(length - step_size, 0) + 1)
+            burn_in_start = max(start - burn_in_steps, 0)
+            hidden = initial_hidden
+            if self.hidden_interval is not None and len(stored_hiddens) > 0:
+                # The k-th stored hidden state (k >= 1) is the one before step k * hidden_interval
+                k = burn_in_start // self.hidden_interval
+                if k <= len(stored_hiddens[0]):
+                    burn_in_start = k * self.hidden_interval
+                    if k > 0:
+                        hidden = stored_hiddens[0][k - 1]
+            hiddens.append(hidden)
+            burn_ins.append(observation[burn_in_start:start])
+            at_beginnings.append(start == 0)
+
+            if start + step_size < length:
+                next_observation_last = observation[start + step_size]
+            else:
+                next_observation_last = np.zeros_like(observation[0])
+            window = slice(start, start + step_size)
+            windows.append((*(pad_segment(item[window], step_size)
+                              for item in (observation, action, reward, done)),
+                            next_observation_last))
+
+        # size: (step_size, batch_size, item_size)
+        observation, action, reward, done = [to_tensor(np.stack(items, axis=1), device=self.model_device).float()
+                                             for items in tuple(zip(*windows))[:4]]
+        # size: (1, batch_size, item_size)
+        next_observation_last = to_tensor(np.stack([window[-1] for window in windows]),
+                                          device=self.model_device).float().unsqueeze(dim=0)
+
+        # size: (batch_size, hidden_size)
+        hidden = to_tensor(np.stack(hiddens), device=self.model_device)
+        n_burn_in_steps = max(map(len, burn_ins))
+        if n_burn_in_steps > 0:
+            # Burn-in prefixes of different lengths are right-aligned and masked
+            # size: (n_burn_in_steps, batch_size, item_size)
+            burn_in_observation = np.zeros(shape=(n_burn_in_steps, batch_size, *observation.shape[2:]),
+                                           dtype=np.float32)
+            mask = np.zeros(shape=(n_burn_in_steps, batch_size, 1), dtype=np.bool_)
+            for i, burn_in in enumerate(burn_ins):
+                if len(burn_in) > 0:
+                    burn_in_observation[-len(burn_in):, i] = burn_in
+                    mask[-len(burn_in):, i] = True
+            burn_in_observation = to_tensor(burn_in_observation, device=self.model_device)
+            mask = torch.from_numpy(mask).to(self.model_device)
+
+            with torch.no_grad():
+                for t in range(n_burn_in_steps):
+                    new_hidden = hidden.clone()
+                    self.state_encoder.encoder.step(burn_in_observation[t], new_hidden)
+                    hidden = torch.where(mask[t], new_hidden, hidden)
+        if any(at_beginnings):
+            # size: (batch_size, 1)
+            at_beginnings = torch.tensor(at_beginnings, device=self.model_device).unsqueeze(dim=1)
+            hidden = torch.where(at_beginnings, live_initial_hidden, hidden)
+        hidden = GRUHidden(tensor=hidden.unsqueeze(dim=0), sizes=self.state_encoder.encoder.hidden_sizes)
+
+        # size: (step_size, batch_size, item_size)
+        state, hidden_last, _ = self.state_encoder(observation, hidden)
+        with torch.no_grad():
+            next_state_last, _, _ = self.state_encoder(next_observation_last, hidden_last)
+            next_state = torch.cat([state[1:].detach(), next_state_last], dim=0)
+
+        # size: (batch_size * step_size, item_size)
+        state, action, reward, next_state, done \
+            = tuple(map(lambda x: x.view(batch_size * step_size, -1),
+                        [state, action, reward, next_state, done]))
+
+        # size: (batch_size * step_size, 1)
+        mask = None
+        if variable_length_segments:
+            mask = (torch.arange(step_size).unsqueeze(dim=1) < torch.LongTensor(lengths).clamp(max=step_size))
+            mask = mask.view(step_size * batch_size, 1).float().to(self.model_device)
 
-        return state, action, reward, next_state, done
+        return state, action, reward, next_state, done, mask
 
     @property
     @lru_cache(maxsize=None)
@@ -1,6 +1,7 @@
 import torch
 
-from ..network import StateEncoderWrapper as OriginalStateEncoderWrapper
+from common.utils import to_tensor
+from ..network import StateEncoderWrapper as OriginalStateEncoderWrapper, EagerPolicy
 
 
 __all__ = ['StateEncoderWrapper']
@@ -13,13 +14,34 @@ class StateEncoderWrapper(OriginalStateEncoderWrapper):
 
     @torch.no_grad()
     def encode(self, observation):
-        observation = torch.FloatTensor(observation).unsqueeze(dim=0).unsqueeze(dim=0).to(self.device)
-        encoded, self.hidden, _ = self(observation, self.hidden)
-        encoded = encoded.cpu().numpy()[0, 0]
+        observation = to_tensor(observation, device=self.device).unsqueeze(dim=0)
+        encoded = self.step(observation)
+        encoded = encoded.cpu().numpy()[0]
         return encoded
 
+    @torch.no_grad()
+    def step(self, observation):
+        # Incremental inference for a batch of environments,
+        # the hidden states are kept in a persistent tensor of size (batch_size, sum(hidden_sizes))
+        if self.hidden is None or self.hidden.size(0) != observation.size(0):
+            self.hidden = torch.empty(observation.size(0), sum(self.encoder.hidden_sizes), device=self.device)
+            self.reset()
+        return self.encoder.step(observation.float(), self.hidden)
+
     def initial_hiddens(self, batch_size=1):
         return self.encoder.initial_hiddens(batch_size=batch_size)
 
-    def reset(self):
-        self.hidden = None
+    def build_policy(self, actor, jit=False):
+        # Hidden states are carried by encode, sample step by step
+        return EagerPolicy(state_encoder=self, actor=actor)
+
+    def reset(self, index=None):
+        # Reset hidden states of all (or the given) environments to the initial hidden
+        hidden = getattr(self, 'hidden', None)
+        if hidden is not None:
+            with torch.no_grad():
+                initial_hidden = self.initial_hiddens(batch_size=1).tensor[0]
+                if index is None:
+                    hidden.copy_(initial_hidden.expand_as(hidden))
+                else:
+                    hidden[index] = initial_hidden
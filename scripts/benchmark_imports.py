@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules loaded by a spawned sampler process: the main module is re-imported as '__mp_main__',
+# then the pickled sampler (collector, environment builder and networks) is unpickled
+SAMPLER_START = ("import runpy; runpy.run_path('main.py', run_name='__mp_main__'); "
+                 "import common.collector, common.environment, sac.network")
+
+
+def get_config():
+    parser = argparse.ArgumentParser(description='Measure import time of CLI and sampler process start.')
+    parser.add_argument('--n-runs', type=int, default=5,
+                        help='number of runs for each measurement (default: 5)')
+    parser.add_argument('--help-budget', type=float, default=0.5, metavar='SECONDS',
+                        help="time budget of 'python main.py --help' (default: 0.5)")
+    parser.add_argument('--sampler-budget', type=float, default=0.5, metavar='SECONDS',
+                        help='time budget of imports in sampler process start '
+                             "beyond 'import torch' (which a sampler always needs) (default: 0.5)")
+    return parser.parse_args()
+
+
+def measure(args, n_runs):
+    durations = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], cwd=ROOT_DIR, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+    return float(np.median(durations))
+
+
+def main():
+    args = get_config()
+
+    torch_duration = measure(['-c', 'import torch'], args.n_runs)
+    results = [
+        ('import torch', torch_duration, np.inf),
+        ('main.py --help', measure(['main.py', '--help'], args.n_runs), args.help_budget),
+        ('sampler start', measure(['-c', SAMPLER_START], args.n_runs), torch_duration + args.sampler_budget)
+    ]
+
+    exceeded = False
+    print(f'{"":16}{"median (s)":>12}{"budget (s)":>12}')
+    for name, duration, budget in results:
+        exceeded = exceeded or (duration > budget)
+        print(f'{name:16}{duration:12.3f}{budget:12.3f}{"  (exceeded)" if duration > budget else ""}')
+
+    if exceeded:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
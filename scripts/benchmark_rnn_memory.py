@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import argparse
+import multiprocessing as mp
+import os
+import resource
+import sys
+import time
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+
+def get_config():
+    parser = argparse.ArgumentParser(description='Measure peak RSS of RNN state encoder training '
+                                                 'against step size with and without gradient checkpointing.')
+    parser.add_argument('--step-sizes', type=int, default=[16, 64, 256, 512], nargs='+', metavar='STEP_SIZE',
+                        help='numbers of continuous steps for update (default: 16 64 256 512)')
+    parser.add_argument('--gradient-checkpointing', type=int, default=16, metavar='N_STEPS',
+                        help='number of time steps per checkpointed chunk (default: 16)')
+    parser.add_argument('--batch-size', type=int, default=256,
+                        help='batch size (default: 256)')
+    parser.add_argument('--observation-dim', type=int, default=64, metavar='DIM',
+                        help='observation dimension (default: 64)')
+    parser.add_argument('--encoder-hidden-dims-before-rnn', type=int, default=[256, 256], nargs='+', metavar='DIM',
+                        help='hidden FC dimensions before GRU layers (default: 256 256)')
+    parser.add_argument('--encoder-hidden-dims-rnn', type=int, default=[256], nargs='+', metavar='DIM',
+                        help='GRU hidden dimensions (default: 256)')
+    parser.add_argument('--encoder-hidden-dims-after-rnn', type=int, default=[256, 64], nargs='+', metavar='DIM',
+                        help='hidden FC dimensions after GRU layers (default: 256 64)')
+    parser.add_argument('--n-threads', type=int, default=1,
+                        help='number of intra-op threads (default: 1)')
+    return parser.parse_args()
+
+
+def max_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def measure(args, step_size, gradient_checkpointing):
+    # Run in a fresh process since the peak RSS of a process never decreases
+    import torch
+
+    from common.network import RecurrentNeuralNetwork
+
+    torch.set_num_threads(args.n_threads)
+    torch.manual_seed(0)
+    encoder = RecurrentNeuralNetwork(n_dims_before_rnn=[args.observation_dim, *args.encoder_hidden_dims_before_rnn],
+                                     n_dims_rnn_hidden=args.encoder_hidden_dims_rnn,
+                                     n_dims_after_rnn=args.encoder_hidden_dims_after_rnn,
+                                     gradient_checkpointing=gradient_checkpointing)
+    observation = torch.randn(step_size, args.batch_size, args.observation_dim)
+
+    # Warm up allocator and kernels on a short sequence
+    encoder(observation[:1])[0].sum().backward()
+    encoder.zero_grad()
+    baseline = max_rss()
+
+    start = time.perf_counter()
+    state, _, _ = encoder(observation)
+    state.square().mean().backward()
+    duration = time.perf_counter() - start
+
+    return max_rss() - baseline, duration
+
+
+def main():
+    args = get_config()
+
+    print(f'batch_size = {args.batch_size}, gradient_checkpointing = {args.gradient_checkpointing}')
+    print(f'{"step_size":>10}{"peak RSS (MB)":>16}{"checkpointed":>16}{"time (ms)":>12}{"checkpointed":>16}')
+    context = mp.get_context('spawn')
+    for step_size in args.step_sizes:
+        results = []
+        for gradient_checkpointing in (None, args.gradient_checkpointing):
+            with context.Pool(processes=1) as pool:
+                results.append(pool.apply(measure, (args, step_size, gradient_checkpointing)))
+        (memory, duration), (checkpointed_memory, checkpointed_duration) = results
+        print(f'{step_size:10d}{memory:16.1f}{checkpointed_memory:16.1f}'
+              f'{1E3 * duration:12.1f}{1E3 * checkpointed_duration:16.1f}')
+
+
+if __name__ == '__main__':
+    main()
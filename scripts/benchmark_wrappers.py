@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import time
+
+import gym
+import numpy as np
+from gym.spaces import Box
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from common.environment import build_env
+
+
+class NullEnv(gym.Env):
+    def __init__(self, observation_shape=(8, 4), action_shape=(3, 2), image_size=(400, 600)):
+        self.observation_space = Box(low=-1.0, high=1.0, shape=observation_shape, dtype=np.float32)
+        self.action_space = Box(low=-2.0, high=2.0, shape=action_shape, dtype=np.float32)
+        self.observation = np.zeros(shape=observation_shape, dtype=np.float32)
+        self.image = np.zeros(shape=(*image_size, 3), dtype=np.uint8)
+
+    def reset(self):
+        return self.observation
+
+    def step(self, action):
+        return self.observation, 0.0, False, {}
+
+    def render(self, mode='human'):
+        return self.image
+
+    def seed(self, seed=None):
+        return [seed]
+
+
+gym.register(id='NullEnv-v0', entry_point=NullEnv, max_episode_steps=1000)
+
+
+def get_config():
+    parser = argparse.ArgumentParser(description='Benchmark per-step overhead of environment wrappers.')
+    parser.add_argument('--env', type=str, default='NullEnv-v0',
+                        help='environment to benchmark (default: NullEnv-v0 (no-op environment))')
+    parser.add_argument('--n-frames', type=int, default=4,
+                        help='concatenate original N consecutive observations as a new observation (default: 4)')
+    parser.add_argument('--vision-observation', action='store_true',
+                        help='use rendered images as observation')
+    parser.add_argument('--image-size', type=int, default=96, metavar='SIZE',
+                        help='image size of vision observation (default: 96)')
+    parser.add_argument('--n-steps', type=int, default=100000,
+                        help='number of environment steps (default: 100000)')
+    return parser.parse_args()
+
+
+def benchmark(env, n_steps):
+    env.reset()
+    action = np.zeros(shape=env.action_space.shape, dtype=env.action_space.dtype)
+    start = time.perf_counter()
+    for step in range(n_steps):
+        _, _, done, _ = env.step(action)
+        if done:
+            env.reset()
+    return (time.perf_counter() - start) / n_steps
+
+
+def main():
+    args = get_config()
+
+    env_kwargs = dict(name=args.env,
+                      vision_observation=args.vision_observation,
+                      image_size=args.image_size,
+                      n_frames=args.n_frames,
+                      max_episode_steps=1000,
+                      random_seed=0)
+
+    with gym.make(args.env) as env:
+        env.seed(0)
+        raw_time = benchmark(env, args.n_steps)
+    with build_env(**env_kwargs, fused_wrappers=False) as env:
+        stack_time = benchmark(env, args.n_steps)
+    with build_env(**env_kwargs, fused_wrappers=True) as env:
+        fused_time = benchmark(env, args.n_steps)
+
+    print(f'env = {args.env}, n_frames = {args.n_frames}, vision_observation = {args.vision_observation}')
+    print(f'{"":16}{"step (us)":>12}{"overhead (us)":>16}')
+    for name, step_time in [('raw', raw_time), ('wrapper stack', stack_time), ('fused wrapper', fused_time)]:
+        print(f'{name:16}{1E6 * step_time:12.2f}{1E6 * (step_time - raw_time):16.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import argparse
+import copy
+import os
+import sys
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+
+def get_config():
+    parser = argparse.ArgumentParser(description='Check losses of learning updates with bfloat16 autocast '
+                                                 'against float32.')
+    parser.add_argument('--observation-dim', type=int, default=17, metavar='DIM',
+                        help='observation dimension (default: 17)')
+    parser.add_argument('--state-dim', type=int, default=32, metavar='DIM',
+                        help='state dimension (default: 32)')
+    parser.add_argument('--action-dim', type=int, default=6, metavar='DIM',
+                        help='action dimension (default: 6)')
+    parser.add_argument('--hidden-dims', type=int, default=[256, 256], nargs='+', metavar='DIM',
+                        help='hidden dimensions of controller networks (default: 256 256)')
+    parser.add_argument('--critic-ensemble-size', type=int, default=None, metavar='E',
+                        help='use a fused ensemble of E soft Q networks (use two soft Q networks if not present)')
+    parser.add_argument('--batch-size', type=int, default=256,
+                        help='batch size (default: 256)')
+    parser.add_argument('--n-batches', type=int, default=10,
+                        help='number of batches, each updated from the same initial state (default: 10)')
+    parser.add_argument('--tolerance', type=float, default=2E-2,
+                        help='max relative loss difference (|bf16 - fp32| / (|fp32| + 1E-3)) (default: 2E-2)')
+    return parser.parse_args()
+
+
+def main():
+    args = get_config()
+
+    import torch.multiprocessing as mp
+
+    from common.network import VanillaNeuralNetwork
+    from sac.model import Trainer
+
+    mp.set_start_method('spawn', force=True)
+
+    torch.manual_seed(0)
+    model = Trainer(env_func=None, env_kwargs={},
+                    state_encoder=VanillaNeuralNetwork(n_dims=[args.observation_dim, 64, args.state_dim]),
+                    state_dim=args.state_dim, action_dim=args.action_dim, hidden_dims=args.hidden_dims,
+                    activation=nn.ReLU(inplace=True), initial_alpha=1.0,
+                    critic_lr=1E-4, actor_lr=1E-4, alpha_lr=1E-4, weight_decay=0.0,
+                    n_samplers=0, buffer_capacity=args.batch_size, devices=[torch.device('cpu')],
+                    critic_ensemble_size=args.critic_ensemble_size)
+    model.collector.manager.shutdown()
+
+    rng = np.random.RandomState(0)
+    state_dict = copy.deepcopy(model.state_dict())
+
+    failed = False
+    print(f'{"":8}{"critic loss":>16}{"actor loss":>16}{"max rel diff":>16}')
+    for i in range(args.n_batches):
+        batch = tuple(map(torch.from_numpy, (
+            rng.randn(args.batch_size, args.observation_dim).astype(np.float32),
+            rng.uniform(-1.0, 1.0, size=(args.batch_size, args.action_dim)).astype(np.float32),
+            rng.randn(args.batch_size, 1).astype(np.float32),
+            rng.randn(args.batch_size, args.observation_dim).astype(np.float32),
+            np.zeros(shape=(args.batch_size, 1), dtype=np.float32)
+        )))
+
+        losses = []
+        for bf16_autocast in (False, True):
+            # The same initial state and noise for both precisions
+            model.load_state_dict(copy.deepcopy(state_dict))
+            torch.manual_seed(i)
+            with model.autocast(enabled=bf16_autocast):
+                state, action, reward, next_state, done = model.encode_batch(*batch)
+            info = model.update_sac(state, action, reward, next_state, done,
+                                    target_entropy=-1.0 * args.action_dim, bf16_autocast=bf16_autocast)
+            losses.append(np.array([info['critic_loss'].item(), info['actor_loss'].item()]))
+
+        difference = (np.abs(losses[1] - losses[0]) / (np.abs(losses[0]) + 1E-3)).max()
+        exceeded = difference > args.tolerance
+        failed = failed or exceeded
+        print(f'{i:<8d}{losses[0][0]:16.4f}{losses[0][1]:16.4f}{difference:16.2E}'
+              f'{"  (exceeded)" if exceeded else ""}')
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
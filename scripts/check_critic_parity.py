@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+import argparse
+import copy
+import os
+import sys
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.func import functional_call
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from sac.network import Critic, EnsembleCritic
+
+
+def get_config():
+    parser = argparse.ArgumentParser(description='Check values and gradients of the one-pass critic evaluation '
+                                                 'against two separate critic calls, and losses and gradients '
+                                                 'of update_sac against the three-pass critic evaluation.')
+    parser.add_argument('--observation-dim', type=int, default=17, metavar='DIM',
+                        help='observation dimension of update_sac batches (default: 17)')
+    parser.add_argument('--state-dim', type=int, default=17, metavar='DIM',
+                        help='state dimension (default: 17)')
+    parser.add_argument('--action-dim', type=int, default=6, metavar='DIM',
+                        help='action dimension (default: 6)')
+    parser.add_argument('--hidden-dims', type=int, default=[64, 64], nargs='+', metavar='DIM',
+                        help='hidden dimensions of soft Q networks (default: 64 64)')
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='batch size (default: 32)')
+    parser.add_argument('--n-batches', type=int, default=5,
+                        help='number of update_sac batches, each updated from the same initial state (default: 5)')
+    parser.add_argument('--tolerance', type=float, default=1E-5,
+                        help='max absolute difference of values and gradients (default: 1E-5)')
+    return parser.parse_args()
+
+
+def two_call_evaluate(critic, state, action, new_action):
+    # Reference: Q values of new actions from a second call with detached critic parameters and states
+    q_values = critic(state, action)
+    params = {name: param.detach() for name, param in critic.named_parameters()}
+    new_q_values = functional_call(critic, params, (state.detach(), new_action))
+    return q_values, new_q_values
+
+
+def values_and_gradients(critic, evaluate, inputs):
+    state, action, new_action = [tensor.detach().clone().requires_grad_(True) for tensor in inputs]
+    critic.zero_grad()
+    q_values, new_q_values = evaluate(critic, state, action, new_action)
+
+    # Distinct weights for Q values of different networks and actions, so gradients do not cancel out
+    loss = sum((i + 1) * q_value.square().mean() for i, q_value in enumerate(q_values)) \
+        + sum((i + 1) * new_q_value.mean() for i, new_q_value in enumerate(new_q_values))
+    loss.backward()
+
+    values = [*q_values, *new_q_values]
+    gradients = [state.grad, action.grad, new_action.grad, *(param.grad for param in critic.parameters())]
+    return values, [torch.zeros(()) if gradient is None else gradient for gradient in gradients]
+
+
+def three_pass_update_sac(model, state, action, reward, next_state, done, target_entropy,
+                          gamma=0.99, epsilon=1E-6):
+    # Reference: loss computation of update_sac with three online critic calls critic(s, a), critic(s, a_new)
+    # and critic(s, a_new.detach()), the critic and state gradients of the last two cancel out
+    # (gradients are left in .grad as update_sac does, the optimizer step is skipped)
+    with torch.no_grad():
+        reward = (reward - reward.mean()) / (reward.std() + epsilon)
+
+    new_action, log_prob, _ = model.actor.evaluate(state)
+    alpha_loss = -(model.log_alpha * (log_prob + target_entropy).detach()).mean()
+    model.alpha_optimizer.zero_grad()
+    alpha_loss.backward()
+    model.alpha_optimizer.step()
+    with torch.no_grad():
+        alpha = model.log_alpha.exp()
+
+    predicted_q_value_1, predicted_q_value_2 = model.critic(state, action)
+    with torch.no_grad():
+        new_next_action, next_log_prob, _ = model.actor.evaluate(next_state)
+
+        target_q_min = torch.min(*model.target_critic(next_state, new_next_action))
+        target_q_min -= alpha * next_log_prob
+        target_q_value = reward + (1 - done) * gamma * target_q_min
+    critic_loss_1 = model.critic_criterion(predicted_q_value_1, target_q_value)
+    critic_loss_2 = model.critic_criterion(predicted_q_value_2, target_q_value)
+    critic_loss = (critic_loss_1 + critic_loss_2) / 2.0
+
+    predicted_new_q_value = torch.min(*model.critic(state, new_action))
+    predicted_new_q_value_critic_grad_only = torch.min(*model.critic(state, new_action.detach()))
+    actor_loss = (alpha * log_prob - predicted_new_q_value).mean()
+    actor_loss_unbiased = actor_loss + predicted_new_q_value_critic_grad_only.mean()
+
+    loss = critic_loss + model.actor_loss_weight * actor_loss_unbiased
+    model.optimizer.zero_grad()
+    loss.backward()
+
+    return {'critic_loss': critic_loss.detach(), 'actor_loss': actor_loss.detach()}
+
+
+def check_update_sac(args):
+    import torch.multiprocessing as mp
+
+    from common.network import VanillaNeuralNetwork
+    from sac.model import Trainer
+
+    mp.set_start_method('spawn', force=True)
+
+    target_entropy = -1.0 * args.action_dim
+    failed = False
+    print(f'{"":16}{"critic loss":>12}{"actor loss":>12}{"gradients":>12}')
+    for critic_ensemble_size in (None, 2):
+        torch.manual_seed(0)
+        model = Trainer(env_func=None, env_kwargs={},
+                        state_encoder=VanillaNeuralNetwork(n_dims=[args.observation_dim, 64, args.state_dim]),
+                        state_dim=args.state_dim, action_dim=args.action_dim, hidden_dims=args.hidden_dims,
+                        activation=nn.ReLU(inplace=True), initial_alpha=1.0,
+                        critic_lr=1E-4, actor_lr=1E-4, alpha_lr=1E-4, weight_decay=0.0,
+                        n_samplers=0, buffer_capacity=args.batch_size, devices=[torch.device('cpu')],
+                        critic_ensemble_size=critic_ensemble_size)
+        model.collector.manager.shutdown()
+        params = [model.log_alpha, *(param for param_group in model.optimizer.param_groups
+                                     for param in param_group['params'])]
+
+        rng = np.random.RandomState(0)
+        state_dict = copy.deepcopy(model.state_dict())
+        differences = np.zeros(shape=(3,))
+        for i in range(args.n_batches):
+            batch = tuple(map(torch.from_numpy, (
+                rng.randn(args.batch_size, args.observation_dim).astype(np.float32),
+                rng.uniform(-1.0, 1.0, size=(args.batch_size, args.action_dim)).astype(np.float32),
+                rng.randn(args.batch_size, 1).astype(np.float32),
+                rng.randn(args.batch_size, args.observation_dim).astype(np.float32),
+                (rng.uniform(size=(args.batch_size, 1)) < 0.1).astype(np.float32)
+            )))
+
+            results = []
+            for update_sac in (model.update_sac, lambda *batch, **kwargs: three_pass_update_sac(model, *batch,
+                                                                                                  **kwargs)):
+                # The same initial state and noise for both loss computations
+                model.load_state_dict(copy.deepcopy(state_dict))
+                torch.manual_seed(i)
+                info = update_sac(*model.encode_batch(*batch), target_entropy=target_entropy)
+                gradients = [torch.zeros(()) if param.grad is None else param.grad.clone() for param in params]
+                results.append((info['critic_loss'], info['actor_loss'], gradients))
+
+            (critic_loss, actor_loss, gradients), (ref_critic_loss, ref_actor_loss, ref_gradients) = results
+            differences = np.maximum(differences, [(critic_loss - ref_critic_loss).abs().item(),
+                                                   (actor_loss - ref_actor_loss).abs().item(),
+                                                   max_difference(gradients, ref_gradients)])
+
+        name = type(model.critic).__name__
+        exceeded = differences.max() > args.tolerance
+        failed = failed or exceeded
+        print(f'{name:16}{differences[0]:12.2E}{differences[1]:12.2E}{differences[2]:12.2E}'
+              f'{"  (exceeded)" if exceeded else ""}')
+
+    return failed
+
+
+def max_difference(tensors_1, tensors_2):
+    return max((tensor_1.detach() - tensor_2.detach()).abs().max().item()
+               for tensor_1, tensor_2 in zip(tensors_1, tensors_2))
+
+
+def main():
+    args = get_config()
+
+    torch.manual_seed(0)
+    critic = Critic(args.state_dim, args.action_dim, args.hidden_dims)
+    ensemble_critic = EnsembleCritic(args.state_dim, args.action_dim, args.hidden_dims, ensemble_size=2)
+    ensemble_critic.load_state_dict(critic.state_dict())
+
+    inputs = (torch.randn(args.batch_size, args.state_dim),
+              torch.rand(args.batch_size, args.action_dim) * 2.0 - 1.0,
+              torch.rand(args.batch_size, args.action_dim) * 2.0 - 1.0)
+
+    # Values of the ensemble critic (loaded from the critic) are also checked against the critic
+    critic_values, _ = values_and_gradients(critic, two_call_evaluate, inputs)
+
+    failed = False
+    print(f'{"":16}{"values":>12}{"gradients":>12}')
+    for name, network in [('Critic', critic), ('EnsembleCritic', ensemble_critic)]:
+        values, gradients = values_and_gradients(network, lambda net, *x: net.evaluate(*x), inputs)
+        ref_values, ref_gradients = values_and_gradients(network, two_call_evaluate, inputs)
+        value_difference = max(max_difference(values, ref_values), max_difference(values, critic_values))
+        gradient_difference = max_difference(gradients, ref_gradients)
+        exceeded = max(value_difference, gradient_difference) > args.tolerance
+        failed = failed or exceeded
+        print(f'{name:16}{value_difference:12.2E}{gradient_difference:12.2E}{"  (exceeded)" if exceeded else ""}')
+
+    # Losses and gradients of update_sac against the three-pass critic evaluation
+    print()
+    failed = check_update_sac(args) or failed
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
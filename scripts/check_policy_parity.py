@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import torch
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from common.network import VanillaNeuralNetwork
+from sac.network import StateEncoderWrapper, Actor, EagerPolicy, FusedPolicy
+
+
+def get_config():
+    parser = argparse.ArgumentParser(description='Check actions of the fused sampler policy '
+                                                 'against state encoder and PolicyNetwork.get_action.')
+    parser.add_argument('--observation-dim', type=int, default=17, metavar='DIM',
+                        help='observation dimension (default: 17)')
+    parser.add_argument('--state-dim', type=int, default=32, metavar='DIM',
+                        help='state dimension (default: 32)')
+    parser.add_argument('--action-dim', type=int, default=6, metavar='DIM',
+                        help='action dimension (default: 6)')
+    parser.add_argument('--hidden-dims', type=int, default=[256, 256], nargs='+', metavar='DIM',
+                        help='hidden dimensions of actor (default: 256 256)')
+    parser.add_argument('--n-observations', type=int, default=100,
+                        help='number of random observations (default: 100)')
+    parser.add_argument('--tolerance', type=float, default=1E-6,
+                        help='max absolute action difference of eager and traced fused policies (default: 1E-6)')
+    parser.add_argument('--quantized-tolerance', type=float, default=5E-2,
+                        help='max absolute deterministic action difference of the int8 quantized policy '
+                             '(actions are in [-1.0, 1.0]) (default: 5E-2)')
+    return parser.parse_args()
+
+
+def actions(policy, observations, deterministic):
+    # The same seed before each step, so stochastic policies draw the same noise
+    results = []
+    for seed, observation in enumerate(observations):
+        torch.manual_seed(seed)
+        results.append(policy.get_action(observation, deterministic=deterministic))
+    return np.stack(results)
+
+
+def main():
+    args = get_config()
+
+    torch.manual_seed(0)
+    state_encoder = StateEncoderWrapper(VanillaNeuralNetwork(n_dims=[args.observation_dim, 64, args.state_dim]))
+    actor = Actor(args.state_dim, args.action_dim, args.hidden_dims)
+    state_encoder.eval().requires_grad_(False)
+    actor.eval().requires_grad_(False)
+
+    rng = np.random.RandomState(0)
+    observations = rng.randn(args.n_observations, args.observation_dim).astype(np.float32)
+
+    reference = EagerPolicy(state_encoder=state_encoder, actor=actor)
+    policies = [('eager', FusedPolicy(state_encoder=state_encoder, actor=actor, jit=False)),
+                ('traced', FusedPolicy(state_encoder=state_encoder, actor=actor, jit=True))]
+
+    failed = False
+    print(f'{"":12}{"deterministic":>16}{"stochastic":>16}{"tolerance":>12}')
+    for name, policy in policies:
+        differences = [np.abs(actions(policy, observations, deterministic)
+                              - actions(reference, observations, deterministic)).max()
+                       for deterministic in (True, False)]
+        exceeded = max(differences) > args.tolerance
+        failed = failed or exceeded
+        if policy.jit and policy.traced is None:
+            print('Failed to trace the policy with TorchScript.')
+            failed = True
+        print(f'{name:12}{differences[0]:16.2E}{differences[1]:16.2E}{args.tolerance:12.2E}'
+              f'{"  (exceeded)" if exceeded else ""}')
+
+    # int8 dynamic quantization changes the actions, checked against a looser tolerance
+    quantized_policy = policies[0][1].quantized()
+    difference = np.abs(quantized_policy.deterministic_actions(observations).numpy()
+                        - actions(reference, observations, deterministic=True)).max()
+    exceeded = difference > args.quantized_tolerance
+    failed = failed or exceeded
+    print(f'{"quantized":12}{difference:16.2E}{"":>16}{args.quantized_tolerance:12.2E}'
+          f'{"  (exceeded)" if exceeded else ""}')
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()